@@ -1 +1,2 @@
-from .core import Assembler
+from .assembler import Assembler, AssemblyError, AssemblyResult, assemble
+from .cache import AssemblyCache
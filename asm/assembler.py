@@ -0,0 +1,658 @@
+"""The LLAMA-16 assembler as a library.
+
+    from asm import assemble
+
+    result = assemble(source)
+    result.image    # the binary, as written to a .OUT file
+    result.symbols  # label -> address
+
+assemble() takes the source as one string or as any iterable of lines,
+such as an open file, and raises AssemblyError on the first error. Every
+call uses its own Assembler, so nothing is shared between assemblies
+except an AssemblyCache passed in to skip the parts of a source that
+were already assembled, see asm/cache.py.
+"""
+import re
+from io import StringIO
+try:
+    from .cache import section_key, split_sections
+except ImportError:
+    from cache import section_key, split_sections
+
+# Most lines are "label: mnemonic op1, op2 ; comment" with every part but
+# the mnemonic optional and no spaces inside the parts. Those are split by
+# this pattern and everything else by Assembler.split_line, which gives the
+# same tokens for these lines.
+LINE_PATTERN = re.compile(r"[ \t]*(?:([^\s:;,.]+):[ \t]*)?"
+                          r"(?:([A-Za-z]+)(?:[ \t]+([^\s:;,.]+)(?:,[ \t]*([^\s:;,.]+))?)?)?"
+                          r"[ \t]*(?:;([^;]*))?\s*\Z")
+
+OP1_REGISTERS = frozenset(["a", "A", "b", "B", "c", "C", "d", "D"])
+OP2_REGISTERS = OP1_REGISTERS | {"ip", "IP", "sp", "SP", "bp", "BP"}
+DIRECTIVE_TYPES = {".data": "data", ".string": "string"}
+# Kinds of event recorded for a cached section
+LABEL, REFERENCE = 0, 1
+OPERAND_PREFIXES = {
+    "[": ("mem_adr", {91: None, 93: None}),  # Remove brackets
+    "#": ("imm", {35: None}),  # Remove number sign
+}
+
+
+def operand_type(operand, registers):
+    """Return an operand without its prefix and its type."""
+    prefix = OPERAND_PREFIXES.get(operand[0])
+    if prefix is not None:
+        return operand.translate(prefix[1]), prefix[0]
+    elif operand in registers:
+        return operand, "reg"
+    return operand, "label"
+
+
+class AssemblyError(Exception):
+    """An error in the source. line_number counts from 1."""
+
+    def __init__(self, message, line_number):
+        super().__init__(message, line_number)
+        self.message = message
+        self.line_number = line_number
+
+    def __str__(self):
+        return f"Assembly error on line {self.line_number}: {self.message}"
+
+
+class AssemblyResult(object):
+    """What assemble() returns.
+
+    image is the binary, symbols maps every label to its address and
+    diagnostics lists problems that did not stop the source assembling.
+    """
+    __slots__ = ('image', 'symbols', 'diagnostics')
+
+    def __init__(self, image, symbols, diagnostics):
+        self.image = image
+        self.symbols = symbols
+        self.diagnostics = diagnostics
+
+
+def assemble(source, debug_mode=False, cache=None):
+    """Assemble source text or an iterable of lines into an AssemblyResult."""
+    if isinstance(source, str):
+        # Split lines the way reading a text file does
+        source = StringIO(source, newline=None)
+    return Assembler(debug_mode).assemble(source, cache)
+
+
+class Assembler(object):
+    """Assembles one source. Use assemble() rather than reusing one."""
+    line_number, address = 0, 0
+    ORIGIN = 0x4000
+    # Bytes preallocated for the binary, enough for the whole address space
+    IMAGE_SIZE = 0x20000
+    # Bytes a program can take up when loaded at ORIGIN
+    MEMORY_SIZE = 2 * (0x10000 - ORIGIN)
+
+    # the tokens per line
+    label, mnemonic, op1, op2, comment = "", "", "", "", ""
+    op1_type, op2_type, comment = "", "", ""
+
+    def __init__(self, debug_mode=False):
+        self.debug_mode = debug_mode
+        self.symbol_table = {}
+        self.fixups = []
+        self.diagnostics = []
+        # Labels and label operands of the section being cached, see assemble_section()
+        self.events = None
+        self.section_start = None
+
+    def assemble(self, lines, cache=None):
+        """Assemble lines in a single pass.
+
+        Code is generated as each line is read, so lines can be any iterable
+        including an open file. Operands naming a label that is not defined
+        yet are written as zero and patched once all of the labels are known.
+        With a cache, sections of the source it already holds are copied
+        from it instead. Returns an AssemblyResult.
+        """
+        self.image = bytearray(self.IMAGE_SIZE)
+        self.size = 0
+        self.line_number = 0
+        try:
+            # Debugging prints every line, so it does not use the cache
+            if cache is None or self.debug_mode:
+                for line in lines:
+                    self.assemble_line(line)
+            else:
+                for section in split_sections(lines):
+                    self.assemble_section(section, cache)
+        except StopIteration:
+            # reach end of file
+            pass
+
+        self.resolve_fixups()
+        image = bytes(memoryview(self.image)[:self.size])
+        if len(image) > self.MEMORY_SIZE:
+            self.diagnostics.append(f"Program is {len(image)} bytes, more than the {self.MEMORY_SIZE} "
+                                    f"bytes of memory from {self.ORIGIN:#x}")
+        return AssemblyResult(image, self.symbol_table, self.diagnostics)
+
+    def assemble_line(self, line):
+        if self.debug_mode:
+            print(f"Line number is {self.line_number}")
+        try:
+            self.parse(line)
+            self.process()
+        except ValueError as error:
+            self.write_error(f"Invalid number: {error}")
+        except OverflowError:
+            self.write_error("Number does not fit in 16 bits")
+        self.line_number += 1
+
+    def assemble_section(self, lines, cache):
+        """Assemble a section of lines, or copy it from the cache.
+
+        A cached section holds its code with every label operand zeroed,
+        plus the labels it defines and the label operands it uses relative
+        to its start. That does not depend on where the section ends up,
+        so it is still valid when the code before it grows or shrinks.
+        """
+        key = section_key(lines)
+        entry = cache.get(key)
+        if entry is not None:
+            self.replay_section(entry)
+            return
+
+        start = self.section_start = self.size, self.address, self.line_number
+        self.events = []
+        for line in lines:
+            self.assemble_line(line)
+        events, self.events = self.events, None
+
+        code = bytearray(self.image[start[0]:self.size])
+        for event in events:
+            if event[0] == REFERENCE:
+                code[event[1]:event[1] + 2] = b"\x00\x00"
+        cache.put(key, [len(lines), self.address - start[1], code.hex(), events])
+
+    def replay_section(self, entry):
+        """Copy a section made by assemble_section() to the current address."""
+        lines, words, code, events = entry
+        size, address, line_number = self.size, self.address, self.line_number
+        self.emit(bytes.fromhex(code))
+        for event in events:
+            self.line_number = line_number + event[-1]
+            if event[0] == LABEL:
+                self.label = event[1]
+                self.address = address + event[2]
+                self.add_label()
+                continue
+            offset, symbol, signed, operand = event[1:5]
+            number = self.symbol_table.get(symbol)
+            if number is None:
+                self.fixups.append((size + offset, symbol, signed, self.line_number, operand))
+                continue
+            try:
+                self.image[size + offset:size + offset + 2] = number.to_bytes(2, byteorder="little", signed=signed)
+            except OverflowError:
+                self.write_error("Number does not fit in 16 bits")
+        self.address = address + words
+        self.line_number = line_number + lines
+
+    def resolve_fixups(self):
+        """Patch the operands that named labels defined after them."""
+        for offset, symbol, signed, line_number, operand in self.fixups:
+            if symbol not in self.symbol_table:
+                self.line_number = line_number
+                self.write_error(f'Undefined label "{operand}"')
+            number = self.symbol_table[symbol]
+            try:
+                self.image[offset:offset + 2] = number.to_bytes(2, byteorder="little", signed=signed)
+            except OverflowError:
+                self.line_number = line_number
+                self.write_error("Number does not fit in 16 bits")
+        self.fixups = []
+
+    def parse(self, line):
+        """Parse and tokenize line of source code.
+
+        Returns the tokens as a (label, mnemonic, op1, op1_type, op2,
+        op2_type, comment) tuple and also sets them on the assembler.
+        """
+        match = LINE_PATTERN.match(line)
+        if match is not None:
+            label, mnemonic, op1, op2, comment = match.groups("")
+            mnemonic = mnemonic.lower()
+            comment = comment.translate({9: 32}).strip()
+        else:
+            label, mnemonic, op1, op2, comment = self.split_line(line)
+            if mnemonic in DIRECTIVE_TYPES:
+                tokens = (label.lower(), mnemonic, op1, DIRECTIVE_TYPES[mnemonic], "", "", comment)
+                return self.set_tokens(tokens)
+            mnemonic = mnemonic.lower()
+
+        op1_type, op2_type = "", ""
+        if op1:
+            op1, op1_type = operand_type(op1, OP1_REGISTERS)
+        if op2:
+            op2, op2_type = operand_type(op2, OP2_REGISTERS)
+        if op1_type == "label" or op2_type == "label":
+            label = label.lower()
+
+        return self.set_tokens((label, mnemonic, op1, op1_type, op2, op2_type, comment))
+
+    def set_tokens(self, tokens):
+        (self.label, self.mnemonic, self.op1, self.op1_type,
+         self.op2, self.op2_type, self.comment) = tokens
+        if self.debug_mode:
+            print(f'Label: {self.label}\nMnemonic: {self.mnemonic}\nOp1: {self.op1}\nOp1 Type: {self.op1_type}\n'
+                  f'Op2: {self.op2}\nOp2 Type: {self.op2_type}\nComment: {self.comment}\n')
+        return tokens
+
+    def split_line(self, line):
+        """Split any line that LINE_PATTERN does not match into label,
+        mnemonic, op1, op2 and comment. Directives are returned with the
+        directive as the mnemonic and its arguments as op1."""
+        # Based on this algorithm from Brian Robert Callahan:
+        # https://briancallahan.net/blog/20210410.html
+        label, mnemonic, op1, op2, comment = "", "", "", "", ""
+
+        preprocess = line.lstrip()  # remove leading whitespace
+        preprocess = preprocess.translate({9: 32})  # replace tabs with spaces
+
+        # Comments
+        comment_left, comment_separator, comment_right = preprocess.rpartition(";")
+        if comment_separator:
+            comment = comment_right.strip()
+        else:
+            # If no comment, then the third argument is the remainder of the line
+            # Strip whitespace as before
+            comment_left = comment_right.rstrip()
+
+        d_label, directive, d_args = self.parse_directive(comment_left)
+        if directive != "":
+            return d_label, directive, d_args, "", comment
+
+        # Second operand
+        op2_left, op2_separator, op2_right = comment_left.rpartition(",")
+        if op2_separator:
+            op2 = op2_right.strip()
+        else:
+            op2_left = op2_right.rstrip()
+
+        # First operand, tabs are already spaces
+        op1_left, op1_separator, op1_right = op2_left.rpartition(" ")
+        if op1_separator == " ":
+            op1 = op1_right.strip()
+        else:
+            op1_left = op1_right.strip()
+
+        # mnemonic from label
+        mnemonic_left, mnemonic_separator, mnemonic_right = op1_left.rpartition(":")
+        if mnemonic_separator:
+            mnemonic = mnemonic_right.strip()
+            label = mnemonic_left.strip()
+        else:
+            mnemonic = mnemonic_right.strip()
+
+        # Fix when mnemonic ends up as first operand
+        if mnemonic == "" and op1 != "" and op2 == "":
+            mnemonic = op1.strip()
+            op1 = ""
+
+        return label, mnemonic, op1, op2, comment
+
+    def parse_directive(self, line):
+        d_label, directive, d_args = "", "", ""
+        left1, sep1, right1 = line.partition(".data")
+        d_type = ".data"
+        if sep1 == "":
+            left1, sep1, right1 = line.partition(".string")
+            d_type = ".string"
+        if sep1 == "":
+            return d_label, directive, d_args
+
+        directive = d_type
+        d_args = right1.strip()
+
+        left2, sep2, right2 = left1.partition(":")
+        if sep2 == ":":
+            left2 = left2.strip()
+            if not left2.isalnum() or left2[0].isdigit():
+                self.write_error(f'Invalid label "{left2}"')
+            d_label = left2
+        elif sep2 != ":" and left2.strip() != "":
+            self.write_error(f'Invalid label "{left2}"')
+
+        return d_label, directive, d_args
+
+    def process(self):
+        if self.mnemonic == self.op1 == self.op2 == "":
+            self.pass_action(0, b"")
+            return
+
+        handler = self.HANDLERS.get(self.mnemonic)
+        if handler is None:
+            self.write_error(f'Unrecognized mnemonic "{self.mnemonic}"')
+        handler(self)
+
+    def mv(self):
+        self.verify_ops(self.op1 != "" and self.op2 != "")
+        # 0x00 = 0
+        opcode = 0
+        opcode = self.encode_operand_types(opcode, 2)
+
+        self.pass_action(2, opcode.to_bytes(2, byteorder="little"))
+        self.immediate_operand()
+        self.memory_address()
+
+    def io(self):
+        self.verify_ops(self.op1 != "" and self.op2 != "")
+        if self.op1_type == 'imm' and (self.op2 == 'in' or self.op2 == 'IN'):
+            self.write_error("Cannot read word into an immediate.")
+        # 0x01 = 1
+        opcode = 1
+        # encode just the data type, IN/OUT will be encoding next
+        opcode = self.encode_operand_types(opcode, 1)
+        if self.op2 == 'in' or self.op2 == 'IN':
+            opcode += 0x1
+        elif self.op2 == 'out' or self.op2 == 'OUT':
+            opcode += 0x2
+        else:
+            self.write_error(f"Error parsing io port. {self.op2} is not a valid port, use IN or OUT.")
+
+        self.pass_action(2, opcode.to_bytes(2, byteorder="little"))
+        self.immediate_operand()
+        self.memory_address()
+
+    def push(self):
+        self.verify_ops(self.op1 != "" and self.op2 == "")
+        # 0x02 = 2
+        opcode = 2
+        opcode = self.encode_operand_types(opcode, 1)
+
+        self.pass_action(2, opcode.to_bytes(2, byteorder="little"))
+        self.immediate_operand()
+        self.memory_address()
+
+    def pop(self):
+        self.verify_ops(self.op1 != "" and self.op2 == "")
+        # 0x03 = 3
+        opcode = 3
+        opcode = self.encode_operand_types(opcode, 1)
+
+        self.pass_action(2, opcode.to_bytes(2, byteorder="little"))
+        self.memory_address()
+
+    def add(self):
+        self.verify_ops(self.op1 != "" and self.op2 != "")
+        # 0x04 = 4
+        opcode = 4
+        opcode = self.encode_operand_types(opcode, 2)
+        self.pass_action(2, opcode.to_bytes(2, byteorder="little"))
+        self.immediate_operand()
+        self.memory_address()
+
+    def sub(self):
+        self.verify_ops(self.op1 != "" and self.op2 != "")
+        # 0x05 = 5
+        opcode = 5
+        opcode = self.encode_operand_types(opcode, 2)
+        self.pass_action(2, opcode.to_bytes(2, byteorder="little"))
+        self.immediate_operand()
+        self.memory_address()
+
+    def inc(self):
+        self.verify_ops(self.op1 != "" and self.op2 == "")
+        # 0x06 = 6
+        opcode = 6
+        opcode = self.encode_operand_types(opcode, 1)
+        self.pass_action(2, opcode.to_bytes(2, byteorder="little"))
+
+    def dec(self):
+        self.verify_ops(self.op1 != "" and self.op2 == "")
+        # 0x07 = 7
+        opcode = 7
+        opcode = self.encode_operand_types(opcode, 1)
+        self.pass_action(2, opcode.to_bytes(2, byteorder="little"))
+
+    def mnemonic_and(self):
+        self.verify_ops(self.op1 != "" and self.op2 != "")
+        # 0x08 = 8
+        opcode = 8
+        opcode = self.encode_operand_types(opcode, 2)
+        self.pass_action(2, opcode.to_bytes(2, byteorder="little"))
+        self.immediate_operand()
+        self.memory_address()
+
+    def mnemonic_or(self):
+        self.verify_ops(self.op1 != "" and self.op2 != "")
+        # 0x08 = 9
+        opcode = 9
+        opcode = self.encode_operand_types(opcode, 2)
+        self.pass_action(2, opcode.to_bytes(2, byteorder="little"))
+        self.immediate_operand()
+        self.memory_address()
+
+    def mnemonic_not(self):
+        self.verify_ops(self.op1 != "" and self.op2 != "")
+        # 0x0A = 10
+        opcode = 10
+        opcode = self.encode_operand_types(opcode, 2)
+        self.pass_action(2, opcode.to_bytes(2, byteorder="little"))
+        self.immediate_operand()
+        self.memory_address()
+
+    def cmp(self):
+        self.verify_ops(self.op1 != "" and self.op2 != "")
+        # 0x0B = 11
+        opcode = 11
+        opcode = self.encode_operand_types(opcode, 2)
+        self.pass_action(2, opcode.to_bytes(2, byteorder="little"))
+        self.immediate_operand()
+        self.memory_address()
+
+    def call(self):
+        self.verify_ops(self.op1 != "" and self.op2 == "")
+        # 0x0C = 12
+        opcode = 12
+        opcode = self.encode_operand_types(opcode, 1)
+        self.pass_action(2, opcode.to_bytes(2, byteorder="little"))
+        self.immediate_operand()
+
+    def jnz(self):
+        self.verify_ops(self.op1 != "" and self.op2 == "")
+        opcode = 13
+        opcode = self.encode_operand_types(opcode, 1)
+        self.pass_action(2, opcode.to_bytes(2, byteorder="little"))
+        self.immediate_operand()
+
+    def ret(self):
+        self.verify_ops(self.op1 == "" and self.op2 == "")
+        # 0x0E = 14
+        self.pass_action(2, b"\x00\xE0")
+
+    def hlt(self):
+        self.verify_ops(self.op1 == self.op2 == "")
+        self.pass_action(2, b"\x00\xF0")
+
+    def directive_data(self):
+        if self.label == "":
+            self.write_error(".data and .string directives must be labeled")
+        self.verify_ops(self.op1 != "" and self.op2 == "")
+
+        try:
+            data = int(self.op1)
+            self.pass_action(2, data.to_bytes(2, byteorder="little", signed=True))
+        except ValueError:
+            self.write_error(f"Error reading \"{self.op1}\", not an integer")
+
+    def directive_string(self):
+        if self.label == "":
+            self.write_error(".data and .string directives must be labeled")
+        self.verify_ops(self.op1 != "" and self.op2 == "")
+
+        string = self.op1
+        string = string.strip('\"').strip('\'')
+        if len(string) % 2 != 0:
+            string += '\0'
+        else:
+            string += '\0\0'
+        data = bytes(string, encoding='utf-8')
+        self.pass_action(len(data), data)
+
+    def encode_operand_types(self, opcode, num_ops):
+        opcode = opcode << 12
+        if self.op1_type == "imm":
+            opcode += (14 << 4)
+        elif self.op1_type == "reg":
+            opcode += (self.register_offset(self.op1) << 4)
+        elif self.op1_type == "mem_adr" or self.op1_type == "label":
+            if self.debug_mode:
+                print(f"DEBUG: Symbol table: {self.symbol_table}")
+            opcode += (15 << 4)
+        elif self.op2_type == "":
+            pass
+        else:
+            self.write_error(f'Invalid operand "{self.op1}"')
+
+        if num_ops == 1:
+            return opcode
+
+        if self.op2_type == "reg":
+            opcode += (self.register_offset(self.op2))
+        elif self.op2_type == "mem_adr" or self.op2_type == "label":
+            if self.debug_mode:
+                print(f"DEBUG: Symbol table: {self.symbol_table}")
+            opcode += 15
+        elif self.op2_type == "":
+            pass
+        else:
+            self.write_error(f'Invalid operand "{self.op2}"')
+        return opcode
+
+    def immediate_operand(self):
+        # This function also handles LABEL operands. Should this be its own function
+        # for ease of readablity and debugging?
+        if (self.op1_type != "imm" and self.op1_type != "label"):
+            return
+
+        operand = self.op1
+        self.address += 1
+
+        # Numerical
+        if operand[0].isdigit():
+            number = int(operand)
+        elif operand.startswith('-'):
+            number = int(operand)
+        # Label
+        else:
+            operand = operand.lower()
+            self.reference(operand, True, operand)
+            return
+
+        self.emit(number.to_bytes(2, byteorder="little", signed=True))
+
+    def memory_address(self):
+        if self.op1_type == "mem_adr":
+            operand = self.op1
+            self.address += 1
+
+            if operand[0].isdigit():
+                number = int(operand, 16)
+                self.emit(number.to_bytes(2, byteorder="little"))
+            else:
+                self.reference(operand.lower(), False, operand)
+
+        if self.op2_type == "mem_adr":
+            operand = self.op2
+            self.address += 1
+
+            if operand[0].isdigit():
+                number = int(operand, 16)
+                self.emit(number.to_bytes(2, byteorder="little"))
+            else:
+                self.reference(operand.lower(), False, operand)
+
+    def register_offset(self, reg_in):
+        reg = reg_in.lower()
+        if reg == "a":
+            return 0
+        elif reg == "b":
+            return 1
+        elif reg == "c":
+            return 2
+        elif reg == "d":
+            return 3
+        elif reg == "ip":
+            return 4
+        elif reg == 'sp':
+            return 5
+        elif reg == 'bp':
+            return 6
+        else:
+            self.write_error(f'Invalid register "{reg}"')
+
+    def verify_ops(self, valid):
+        if not valid:
+            self.write_error(f'Invalid operands for mnemonic "{self.mnemonic}"')
+
+    def write_error(self, message):
+        if self.debug_mode:
+            print(f"DEBUG: Current address: {self.address}\nDEBUG: Current symbol table: {self.symbol_table}")
+        raise AssemblyError(message, self.line_number + 1)
+
+    def pass_action(self, size, output_byte):
+        """Define the line's label, then generate code.
+
+        Args:
+            size: Number of bytes in the instruction
+            output_byte: Opcode, empty binary is no output generated
+        """
+        align = size % 2
+
+        if self.label:
+            self.add_label()
+        self.address += int(size/2) + align
+        if output_byte != b"":
+            self.emit(output_byte)
+
+    def emit(self, data):
+        """Write data at the end of the binary."""
+        end = self.size + len(data)
+        # Past the end of the image the slice assignment grows it
+        self.image[self.size:end] = data
+        self.size = end
+
+    def reference(self, symbol, signed, operand):
+        """Write the address of symbol, or a word to patch once it is defined.
+
+        Args:
+            symbol: The label in lower case
+            signed: Whether the address is written as a signed immediate
+            operand: The label as named in errors
+        """
+        if self.events is not None:
+            self.events.append((REFERENCE, self.size - self.section_start[0], symbol, signed, operand,
+                                self.line_number - self.section_start[2]))
+        number = self.symbol_table.get(symbol)
+        if number is None:
+            self.fixups.append((self.size, symbol, signed, self.line_number, operand))
+            number = 0
+        self.emit(number.to_bytes(2, byteorder="little", signed=signed))
+
+    def add_label(self):
+        """Add label to symbol table."""
+        symbol = self.label.lower()
+        if symbol in self.symbol_table:
+            self.write_error(f'Duplicate label: "{self.label}"')
+        self.symbol_table[symbol] = self.address + self.ORIGIN
+        if self.events is not None:
+            self.events.append((LABEL, self.label, self.address - self.section_start[1],
+                                self.line_number - self.section_start[2]))
+
+    # Mnemonics and directives to the methods assembling them
+    HANDLERS = {
+        "mv": mv, "io": io, "push": push, "pop": pop, "add": add, "sub": sub,
+        "inc": inc, "dec": dec, "and": mnemonic_and, "or": mnemonic_or,
+        "not": mnemonic_not, "cmp": cmp, "call": call, "jnz": jnz, "ret": ret,
+        "hlt": hlt, ".data": directive_data, ".string": directive_string,
+    }
@@ -0,0 +1,108 @@
+"""An on-disk cache of assembled source sections.
+
+assemble() splits a source into sections of up to MAX_SECTION_LINES lines
+and looks each one up by a hash of its text. A section is cut after any
+line whose CRC ends in SECTION_BITS zero bits, so where sections end
+depends on the lines themselves rather than their position. Editing a line
+only changes the section holding it, and the rest are copied from the
+cache with their labels and label operands fixed up for wherever they now
+start.
+
+    cache = AssemblyCache("program.CACHE")
+    result = assemble(source, cache=cache)
+    cache.save()
+
+The file is JSON and only keeps the sections used by the last assembly.
+It is ignored if it was written by a different version of the assembler.
+"""
+import hashlib
+import json
+import os
+import zlib
+
+CACHE_VERSION = 1
+SECTION_BITS = 4
+MAX_SECTION_LINES = 256
+
+_fingerprint = None
+
+
+def split_sections(lines):
+    """Yield lists of lines from any iterable of lines."""
+    mask = (1 << SECTION_BITS) - 1
+    section = []
+    for line in lines:
+        section.append(line)
+        if not zlib.crc32(line.encode("utf-8", "surrogatepass")) & mask or len(section) == MAX_SECTION_LINES:
+            yield section
+            section = []
+    if section:
+        yield section
+
+
+def section_key(lines):
+    return hashlib.sha1("".join(lines).encode("utf-8", "surrogatepass")).hexdigest()
+
+
+def assembler_fingerprint():
+    """Return a hash of the assembler source, so a changed assembler never
+    reuses code cached by an older one."""
+    global _fingerprint
+    if _fingerprint is None:
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "assembler.py")
+        try:
+            with open(path, "rb") as file:
+                _fingerprint = hashlib.sha1(file.read()).hexdigest()
+        except OSError:
+            # Frozen builds have no source to hash
+            _fingerprint = str(CACHE_VERSION)
+    return _fingerprint
+
+
+class AssemblyCache(object):
+    """Assembled sections by key, read from and saved to filename."""
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.sections = {}
+        # the sections looked up or added since loading, which save() keeps
+        self.used = {}
+        self.hits, self.misses = 0, 0
+        if filename is not None:
+            self.load()
+
+    def load(self):
+        try:
+            with open(self.filename, "r") as file:
+                cache = json.load(file)
+        except (OSError, ValueError):
+            return
+        if (isinstance(cache, dict) and cache.get("version") == CACHE_VERSION
+                and cache.get("assembler") == assembler_fingerprint()):
+            self.sections = cache.get("sections", {})
+
+    def get(self, key):
+        entry = self.used.get(key) or self.sections.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.used[key] = entry
+        return entry
+
+    def put(self, key, entry):
+        self.used[key] = entry
+
+    def save(self, filename=None):
+        """Write the cache, replacing the old file only once it is complete."""
+        filename = filename or self.filename
+        if filename == self.filename and not self.misses and len(self.used) == len(self.sections):
+            # Every section came from the file, so it is up to date
+            return
+        # dumps() is much faster than streaming to the file with dump()
+        text = json.dumps({"version": CACHE_VERSION, "assembler": assembler_fingerprint(),
+                           "sections": self.used}, separators=(",", ":"))
+        temp = f"{filename}.tmp"
+        with open(temp, "w") as file:
+            file.write(text)
+        os.replace(temp, filename)
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+"""Compare instruction dispatch through HANDLER_TABLE with the dispatch it replaced.
+
+Every program runs on the LLAMACpu of this tree and on the one of an older
+revision, by default the last one that decoded through an if/elif chain
+and branched on operand type strings in every handler. Both are stepped
+one instruction at a time with exec_next_instruction(), so only dispatch
+differs, and each run happens in its own process.
+"""
+import argparse
+import io
+import json
+import os
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# The last commit before HANDLER_TABLE
+PREVIOUS_DISPATCH = "c575890"
+
+# prog/multiply.asm style loops, with a memory and with a register operand
+SOURCES = {
+    'memory': """\
+       mv #7, [6000]
+       mv #{outer}, d
+OUTER: mv #{inner}, c
+LOOP:  add [6000], a
+       dec c
+       jnz LOOP
+       dec d
+       jnz OUTER
+       hlt
+""",
+    'register': """\
+       mv #7, b
+       mv #{outer}, d
+OUTER: mv #{inner}, c
+LOOP:  add b, a
+       dec c
+       jnz LOOP
+       dec d
+       jnz OUTER
+       hlt
+""",
+}
+
+
+def assemble(name, source, directory):
+    path = os.path.join(directory, f"{name}.asm")
+    with open(path, "w") as file:
+        file.write(source)
+    subprocess.run([sys.executable, os.path.join(ROOT, "asm", "core.py"), path],
+                   check=True)
+    return os.path.join(directory, f"{name}.OUT")
+
+
+def export_emulator(revision, directory):
+    """Write emu/ as of a git revision into directory and return its path."""
+    archive = subprocess.run(["git", "-C", ROOT, "archive", revision, "emu"],
+                             check=True, stdout=subprocess.PIPE).stdout
+    with tarfile.open(fileobj=io.BytesIO(archive)) as tar:
+        tar.extractall(directory)
+    return os.path.join(directory, "emu")
+
+
+def measure(emulator, program):
+    """Step program to its hlt on the emulator in the emulator directory."""
+    sys.path.insert(0, emulator)
+    from mem import LLAMAMemory
+    from cpu import LLAMACpu, CpuHalted
+
+    memory = LLAMAMemory()
+    memory.load_program(program)
+    step = LLAMACpu(memory).exec_next_instruction
+    steps = 0
+    start = time.perf_counter()
+    try:
+        while True:
+            step()
+            steps += 1
+    except CpuHalted:
+        steps += 1
+    return steps, time.perf_counter() - start
+
+
+def best_run(emulator, program, repeat):
+    runs = []
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, os.path.abspath(__file__), "--worker", emulator, program],
+                                check=True, stdout=subprocess.PIPE, text=True).stdout
+        runs.append(json.loads(output))
+    return min(runs, key=lambda run: run[1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("-n", "--iterations", type=int, default=100,
+                        help="outer loop count, each runs 1000 inner iterations")
+    parser.add_argument("-r", "--repeat", type=int, default=3,
+                        help="number of timed runs, the best one is reported")
+    parser.add_argument("--against", default=PREVIOUS_DISPATCH, metavar="REVISION",
+                        help=f"git revision to compare with, {PREVIOUS_DISPATCH} by default")
+    parser.add_argument("--worker", nargs=2, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        print(json.dumps(measure(*args.worker)))
+        return
+
+    with tempfile.TemporaryDirectory() as directory:
+        try:
+            previous = export_emulator(args.against, directory)
+        except subprocess.CalledProcessError:
+            parser.error(f"can not read emu/ at revision {args.against} from git")
+        current = os.path.join(ROOT, "emu")
+        for name, source in SOURCES.items():
+            program = assemble(name, source.format(outer=args.iterations, inner=1000), directory)
+            old_steps, old_elapsed = best_run(previous, program, args.repeat)
+            steps, elapsed = best_run(current, program, args.repeat)
+            if steps != old_steps:
+                sys.exit(f"{name}: {steps} instructions, but {old_steps} at {args.against}")
+            old_rate, rate = steps / old_elapsed, steps / elapsed
+            print(f"{name:<9} {steps} instructions: {old_rate:,.0f} instructions/s at {args.against}, "
+                  f"{rate:,.0f} now, {rate / old_rate:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,356 @@
+#!/usr/bin/env python3
+"""Benchmark suite for the LLAMA-16 assembler and emulator.
+
+Every workload is generated on the fly and runs in a fresh Python process,
+so its peak memory is its own. The emulator workloads report guest
+instructions per second, the assembler workloads assembled lines per
+second, the reassembly workload how long assembling a source again with
+one line changed takes using the assembly cache, and the startup workloads
+how long the command line tools take to start and exit.
+
+Results are printed and can be written to a JSON file with -o. Every
+metric is compared against bench/baseline.json, or the file given with
+--baseline, and the suite exits with status 1 if anything got slower or
+bigger by more than the tolerance. Without a baseline file, or with one
+run at another --scale, nothing is compared. Write a new baseline with
+--update-baseline.
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "emu"))
+sys.path.insert(0, os.path.join(ROOT, "asm"))
+
+BASELINE = os.path.join(ROOT, "bench", "baseline.json")
+RESULTS_VERSION = 1
+
+# How each metric is compared with the baseline
+HIGHER_IS_BETTER = ('instructions_per_second', 'lines_per_second')
+LOWER_IS_BETTER = ('seconds', 'peak_rss_kib')
+# Metrics that describe the workload itself and have to match exactly
+EXACT = ('instructions', 'lines')
+
+LOOP_SOURCE = """\
+       mv #{outer}, d
+OUTER: mv #1000, c
+LOOP:  add #3, a
+       dec c
+       jnz LOOP
+       dec d
+       jnz OUTER
+       hlt
+"""
+
+RECURSION_SOURCE = """\
+       mv #{repeat}, d
+OUTER: mv #{depth}, a
+       call REC
+       dec d
+       jnz OUTER
+       hlt
+REC:   dec a
+       jnz DEEPER
+       ret
+DEEPER: push a
+       call REC
+       pop b
+       add b, c
+       ret
+"""
+
+STRING_SOURCE = """\
+       mv #{lines}, d
+LOOP:  io [6000], IN
+       io [6000], OUT
+       io MSG, OUT
+       dec d
+       jnz LOOP
+       hlt
+MSG:   .string " - echoed"
+"""
+
+COPY_SOURCE = """\
+       mv #{repeat}, d
+LOOP:
+{copies}
+       dec d
+       jnz LOOP
+       hlt
+"""
+
+
+def assemble(source):
+    """Assemble source text in this process and return the binary."""
+    from assembler import assemble as assemble_source
+    return assemble_source(source).image
+
+
+def run_program(source, stdin=(), jit=False):
+    from machine import Machine
+    machine = Machine(assemble(source), stdin=list(stdin), stdout=io.StringIO(), jit=jit)
+    start = time.perf_counter()
+    result = machine.run()
+    elapsed = time.perf_counter() - start
+    if result.reason != 'halted':
+        raise RuntimeError(f"workload stopped with {result!r}")
+    return result.steps, elapsed
+
+
+def emulator_loop(scale, jit=False):
+    return run_program(LOOP_SOURCE.format(outer=max(1, int(300 * scale))), jit=jit)
+
+
+def emulator_recursion(scale, jit=False):
+    return run_program(RECURSION_SOURCE.format(repeat=max(1, int(200 * scale)), depth=200), jit=jit)
+
+
+def emulator_strings(scale, jit=False):
+    lines = max(1, int(20000 * scale))
+    stdin = [f"line {index} of the string workload" for index in range(lines)]
+    return run_program(STRING_SOURCE.format(lines=lines), stdin, jit=jit)
+
+
+def emulator_copy(scale, jit=False):
+    copies = "\n".join(f"       mv [{0x6000 + offset:X}], [{0x7000 + offset:X}]"
+                       for offset in range(256))
+    return run_program(COPY_SOURCE.format(repeat=max(1, int(500 * scale)), copies=copies), jit=jit)
+
+
+def synthetic_source(lines, seed=1):
+    """Return a program of roughly lines lines using every kind of statement.
+
+    Jumps and calls only go to the first labels, whose addresses still fit
+    the signed immediates labels are assembled into.
+    """
+    rng = random.Random(seed)
+    registers = ['a', 'b', 'c', 'd']
+    out = []
+    label = 0
+    while len(out) < lines:
+        kind = rng.randrange(10)
+        target = f"L{rng.randrange(min(label, 64))}" if label else "L0"
+        if len(out) % 8 == 0:
+            out.append(f"L{label}: mv #{rng.randrange(1000)}, {rng.choice(registers)}")
+            label += 1
+        elif kind == 0:
+            out.append(f"       add [{rng.randrange(0x6000, 0x7000):X}], {rng.choice(registers)} ; memory operand")
+        elif kind == 1:
+            out.append(f"       sub #{rng.randrange(-100, 100)}, {rng.choice(registers)}")
+        elif kind == 2:
+            out.append(f"       cmp {rng.choice(registers)}, {rng.choice(registers)}")
+        elif kind == 3:
+            out.append(f"       jnz {target}")
+        elif kind == 4:
+            out.append(f"       call {target}")
+        elif kind == 5:
+            out.append(f"       push {rng.choice(registers)}")
+            out.append(f"       pop [{rng.randrange(0x6000, 0x7000):X}]")
+        elif kind == 6:
+            out.append(f"S{len(out)}: .string \"text {len(out)}\"")
+        elif kind == 7:
+            out.append(f"D{len(out)}: .data {rng.randrange(-32768, 32768)}")
+        elif kind == 8:
+            out.append("; a comment on its own line")
+        else:
+            out.append(f"       inc {rng.choice(registers)}")
+    out.append("       hlt")
+    return "\n".join(out) + "\n"
+
+
+def assembler_lines(source):
+    start = time.perf_counter()
+    assemble(source)
+    return time.perf_counter() - start
+
+
+def reassembly(source, directory):
+    """Time assembling source with one line changed, using a cache of the original."""
+    from assembler import assemble as assemble_source
+    from cache import AssemblyCache
+    filename = os.path.join(directory, "reassembly.CACHE")
+    cache = AssemblyCache(filename)
+    assemble_source(source, cache=cache)
+    cache.save()
+    lines = source.splitlines(keepends=True)
+    lines[len(lines) // 2] = "       inc b ; edited\n"
+    edited = "".join(lines)
+    start = time.perf_counter()
+    cache = AssemblyCache(filename)
+    assemble_source(edited, cache=cache)
+    cache.save()
+    return time.perf_counter() - start
+
+
+def startup(command):
+    start = time.perf_counter()
+    subprocess.run(command, check=True, stdout=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+
+def emulator_startup(directory):
+    program = os.path.join(directory, "startup.OUT")
+    with open(program, "wb") as file:
+        file.write(assemble("hlt\n"))
+    return startup([sys.executable, os.path.join(ROOT, "emu", "core.py"), program])
+
+
+def assembler_startup(directory):
+    source = os.path.join(directory, "startup.asm")
+    with open(source, "w") as file:
+        file.write("hlt\n")
+    return startup([sys.executable, os.path.join(ROOT, "asm", "core.py"), source])
+
+
+EMULATOR_WORKLOADS = {
+    'loop': emulator_loop,
+    'recursion': emulator_recursion,
+    'strings': emulator_strings,
+    'copy': emulator_copy,
+}
+
+
+def workload_names(large=False):
+    names = []
+    for name in EMULATOR_WORKLOADS:
+        names += [f"emu_{name}", f"emu_{name}_jit"]
+    sizes = [10000, 100000] + ([1000000] if large else [])
+    names += [f"asm_{size}" for size in sizes]
+    names += ["reasm_100000"]
+    names += ["startup_emu", "startup_asm"]
+    return names
+
+
+def run_workload(name, scale, repeat):
+    """Run one workload in this process and return its metrics."""
+    import resource
+    metrics = {}
+    if name.startswith("emu_"):
+        jit = name.endswith("_jit")
+        workload = EMULATOR_WORKLOADS[name[4:-4] if jit else name[4:]]
+        runs = [workload(scale, jit) for _ in range(repeat)]
+        steps, elapsed = min(runs, key=lambda run: run[1])
+        metrics.update(instructions=steps, seconds=elapsed,
+                       instructions_per_second=steps / elapsed)
+    elif name.startswith("asm_"):
+        source = synthetic_source(int(name[4:]))
+        lines = source.count("\n")
+        elapsed = min(assembler_lines(source) for _ in range(repeat))
+        metrics.update(lines=lines, seconds=elapsed, lines_per_second=lines / elapsed)
+    elif name.startswith("reasm_"):
+        source = synthetic_source(int(name[6:]))
+        lines = source.count("\n")
+        with tempfile.TemporaryDirectory() as directory:
+            elapsed = min(reassembly(source, directory) for _ in range(repeat))
+        metrics.update(lines=lines, seconds=elapsed, lines_per_second=lines / elapsed)
+    else:
+        tool = emulator_startup if name == "startup_emu" else assembler_startup
+        with tempfile.TemporaryDirectory() as directory:
+            metrics['seconds'] = min(tool(directory) for _ in range(repeat))
+    # Linux reports KiB, macOS bytes
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    metrics['peak_rss_kib'] = peak // 1024 if sys.platform == 'darwin' else peak
+    return metrics
+
+
+def run_isolated(name, scale, repeat):
+    output = subprocess.run([sys.executable, os.path.abspath(__file__), "--worker", name,
+                             "--scale", str(scale), "--repeat", str(repeat)],
+                            check=True, stdout=subprocess.PIPE, text=True).stdout
+    return json.loads(output)
+
+
+def compare(results, baseline, tolerance):
+    """Print every metric next to the baseline and return the regressions."""
+    regressions = []
+    print(f"{'workload':<22} {'metric':<24} {'baseline':>14} {'current':>14} {'change':>8}")
+    for name, metrics in results.items():
+        old_metrics = baseline.get(name)
+        if old_metrics is None:
+            continue
+        for metric, value in metrics.items():
+            old = old_metrics.get(metric)
+            if old is None:
+                continue
+            change = (value - old) / old if old else 0.0
+            if metric in HIGHER_IS_BETTER:
+                worse = change < -tolerance
+            elif metric in LOWER_IS_BETTER:
+                worse = change > tolerance
+            else:
+                worse = metric in EXACT and value != old
+            flag = "  <- regression" if worse else ""
+            print(f"{name:<22} {metric:<24} {_format(old):>14} {_format(value):>14} "
+                  f"{100 * change:>+7.1f}%{flag}")
+            if worse:
+                regressions.append((name, metric, old, value))
+    return regressions
+
+
+def _format(value):
+    return f"{value:,.4g}" if isinstance(value, float) else f"{value:,}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="LLAMA-16 benchmark suite")
+    parser.add_argument("-o", "--output", metavar="FILE", help="write the results to FILE as JSON")
+    parser.add_argument("--baseline", default=BASELINE, metavar="FILE",
+                        help="results to compare against, bench/baseline.json by default")
+    parser.add_argument("--update-baseline", action="store_true",
+                        help="write the results to the baseline file instead of comparing")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+                        help="allowed slowdown or growth before a metric counts as a regression, 0.1 by default")
+    parser.add_argument("--scale", type=float, default=1.0,
+                        help="multiply the size of the emulator workloads")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="number of timed runs per workload, the best one is reported")
+    parser.add_argument("--large", action="store_true", help="also assemble a 1,000,000 line source")
+    parser.add_argument("--only", nargs="+", metavar="NAME", help="only run these workloads")
+    parser.add_argument("--worker", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        print(json.dumps(run_workload(args.worker, args.scale, args.repeat)))
+        return
+
+    results = {}
+    for name in args.only or workload_names(args.large):
+        metrics = results[name] = run_isolated(name, args.scale, args.repeat)
+        print(name, " ".join(f"{metric}={_format(value)}" for metric, value in metrics.items()),
+              flush=True)
+
+    document = {'version': RESULTS_VERSION, 'python': platform.python_version(),
+                'machine': platform.machine(), 'scale': args.scale, 'results': results}
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(document, file, indent=2)
+    if args.update_baseline:
+        with open(args.baseline, "w") as file:
+            json.dump(document, file, indent=2)
+        return
+
+    if not os.path.exists(args.baseline):
+        print(f"No baseline at {args.baseline}, not comparing. Write one with --update-baseline")
+        return
+    with open(args.baseline, "r") as file:
+        baseline = json.load(file)
+    if baseline.get('scale') != args.scale:
+        print(f"Baseline was run with --scale {baseline.get('scale')}, not comparing")
+        return
+    print()
+    regressions = compare(results, baseline['results'], args.tolerance)
+    if regressions:
+        print(f"\n{len(regressions)} regressions")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1 +1,2 @@
 from .core import Emulator
+from .machine import Machine, MachineResult, MachineSnapshot
@@ -0,0 +1,142 @@
+"""Run a manifest of assembled programs on a pool of worker processes.
+
+A manifest is a JSON list of programs, or an object with a "programs" list
+plus defaults for every program. Each program is a path to a .OUT file or
+an object with these keys:
+
+    program     path to the .OUT file, relative to the manifest
+    id          name reported with the result, defaults to the path
+    input       io input as a string or a list of lines
+    input_file  path to a text file of io input, relative to the manifest
+    max_steps   instruction budget
+    timeout     wall time budget in seconds
+    jit         run on the block translating CPU
+    dump_dir    directory, relative to the manifest, to write a binary dump
+                of the machine to when the program faults, see emu.dump
+    stats       add the performance counters of emu.counters to the result
+
+Every worker process keeps its Machine between programs, so a program only
+costs a load and a run rather than a new interpreter.
+"""
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+try:
+    from .machine import Machine
+    from .stream import FileSource
+except ImportError:
+    from machine import Machine
+    from stream import FileSource
+
+JOB_DEFAULTS = ('max_steps', 'timeout', 'jit', 'dump_dir', 'stats')
+
+# Machines owned by this worker process, by jit flag
+_machines = {}
+
+
+def load_manifest(filename, jit=False):
+    """Read a manifest and return one job dict per program."""
+    with open(filename, 'r') as file:
+        manifest = json.load(file)
+
+    defaults = {'jit': jit}
+    if isinstance(manifest, dict):
+        defaults.update({key: manifest[key] for key in JOB_DEFAULTS if key in manifest})
+        entries = manifest.get('programs', [])
+    else:
+        entries = manifest
+
+    base = os.path.dirname(os.path.abspath(filename))
+    jobs = []
+    for index, entry in enumerate(entries):
+        if isinstance(entry, str):
+            entry = {'program': entry}
+        job = dict(defaults)
+        job.update(entry)
+        job.setdefault('id', entry['program'])
+        job['index'] = index
+        job['program'] = os.path.join(base, entry['program'])
+        for key in ('input_file', 'dump_dir'):
+            if key in job:
+                job[key] = os.path.join(base, job[key])
+        jobs.append(job)
+    return jobs
+
+
+def run_job(job):
+    """Run one job in this process and return its result as a dict."""
+    start = time.perf_counter()
+    record = {'id': job['id'], 'index': job['index'], 'program': job['program']}
+
+    machine = _machines.get(job['jit'])
+    if machine is None:
+        machine = _machines[job['jit']] = Machine(jit=job['jit'])
+
+    try:
+        if 'input_file' in job:
+            stdin = FileSource(job['input_file'])
+        else:
+            stdin = job.get('input', '')
+        machine.set_io(stdin=stdin)
+        machine.load(job['program'])
+        if job.get('stats'):
+            machine.start_stats()
+        result = machine.run(job.get('max_steps'), job.get('timeout'))
+    except Exception as error:
+        # The program could not be loaded, so there is nothing to run
+        record.update(reason='error', steps=0, output=None, error=repr(error))
+    else:
+        record.update(reason=result.reason, steps=result.steps, output=result.output,
+                      error=repr(result.error) if result.error is not None else None)
+        if result.reason == 'fault' and job.get('dump_dir'):
+            dump = os.path.join(job['dump_dir'], f"{job['index']}.l16d")
+            try:
+                with open(dump, 'wb') as file:
+                    file.write(machine.dump())
+            except Exception as error:
+                # A dump that fails must not lose the result of the run
+                record['dump_error'] = repr(error)
+            else:
+                record['dump'] = dump
+        if machine.counters is not None:
+            record['stats'] = machine.counters.totals()
+    machine.stop_stats()
+    record['wall_time'] = time.perf_counter() - start
+    return record
+
+
+def run_batch(jobs, workers=None, outfile=sys.stdout):
+    """Run jobs over worker processes and write a JSON line per finished job.
+
+    Results are written as soon as they are ready, so they are not in
+    manifest order; each one carries the index of its job. A dump that can
+    not be written is reported as dump_error instead of dump. Returns the
+    number of jobs whose program halted.
+    """
+    halted = 0
+
+    def report(record):
+        nonlocal halted
+        halted += record['reason'] == 'halted'
+        outfile.write(json.dumps(record) + "\n")
+        outfile.flush()
+
+    for dump_dir in {job['dump_dir'] for job in jobs if job.get('dump_dir')}:
+        try:
+            os.makedirs(dump_dir, exist_ok=True)
+        except OSError:
+            # Every job that faults reports it when its dump fails
+            pass
+
+    if workers == 1:
+        for job in jobs:
+            report(run_job(job))
+        return halted
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(run_job, job) for job in jobs]
+        for future in as_completed(futures):
+            report(future.result())
+    return halted
@@ -0,0 +1,110 @@
+"""Python source templates for LLAMA-16 instructions.
+
+The generated code runs with these names in scope:
+    r  the register list of the CPU
+    m  the backing array of memory, used for reads
+    w  the CPU's _mem_write, used for every store
+
+Operands are passed in as Python expressions so the same templates can be
+filled in with constants (block translation) or with attribute lookups.
+"""
+
+# Source operand value by operand type
+SRC_VALUES = {
+    'imm': '{0}',
+    'reg': 'r[{0}]',
+    'mem_adr': 'm[{0}]',
+}
+
+# Two operand arithmetic and logic, by opcode
+ALU_OPERATIONS = {
+    0x4: '({dst} + {src}) & 0xFFFF',
+    0x5: '({dst} - {src}) & 0xFFFF',
+    0x8: '{dst} & {src}',
+    0x9: '{dst} | {src}',
+    0xA: '~{src} & 0xFFFF',
+}
+
+# 0000 000H 0GEL 0NZP
+NZP_FLAGS = '(2 if v == 0 else 4 if v > 0x7FFF else 1)'
+GEL_FLAGS = '(0x10 if s < v else 0x20 if s == v else 0x40)'
+
+
+def plain_write(address, value, then=()):
+    return [f"w({address}, {value})"] + list(then)
+
+
+def sets_nzp_flags(opcode, src_type, dst_type):
+    if opcode in ALU_OPERATIONS or opcode == 0xB:
+        return dst_type == 'reg'
+    if opcode in (0x6, 0x7):
+        return src_type == 'reg'
+    return False
+
+
+def emit_instruction(opcode, src_type, dst_type, src, dst, write=plain_write, flags=True):
+    """Return the lines of Python source that execute one instruction.
+
+    Args:
+        opcode: The instruction opcode, anything but io (0x1)
+        src_type, dst_type: Operand types as returned by _get_op_types
+        src, dst: Expressions for the register encoding, immediate or address
+        write: Callable building the lines that store a value to memory,
+            followed by the lines in then which must run once it succeeds
+        flags: False when a later instruction overwrites NZP before use
+
+    IP is expected to already point at the following instruction.
+    """
+    lines = []
+    value = SRC_VALUES[src_type].format(src) if src_type else None
+
+    if opcode == 0x0:
+        if dst_type == 'reg':
+            lines.append(f"r[{dst}] = {value}")
+        elif dst_type == 'mem_adr':
+            lines += write(dst, value)
+    elif opcode in ALU_OPERATIONS:
+        operation = ALU_OPERATIONS[opcode]
+        if dst_type == 'reg':
+            lines.append(f"r[{dst}] = v = " + operation.format(dst=f"r[{dst}]", src=value))
+            if flags:
+                lines.append(f"r[7] = (r[7] & 0xFFF0) + {NZP_FLAGS}")
+        elif dst_type == 'mem_adr':
+            lines += write(dst, operation.format(dst=f"m[{dst}]", src=value))
+    elif opcode in (0x6, 0x7):
+        operator = '+' if opcode == 0x6 else '-'
+        if src_type == 'reg':
+            lines.append(f"r[{src}] = v = (r[{src}] {operator} 1) & 0xFFFF")
+            if flags:
+                lines.append(f"r[7] = (r[7] & 0xFFF0) + {NZP_FLAGS}")
+        elif src_type == 'mem_adr':
+            lines += write(src, f"(m[{src}] {operator} 1) & 0xFFFF")
+    elif opcode == 0x2:
+        # SP only moves once the store has gone through
+        lines += [f"v = {value}", "sp = r[5]"]
+        lines += write("sp", "v", ["r[5] = sp + 1"])
+    elif opcode == 0x3:
+        lines += ["r[5] -= 1", "v = m[r[5]]"]
+        if src_type == 'reg':
+            lines.append(f"r[{src}] = v")
+        elif src_type == 'mem_adr':
+            lines += write(src, "v")
+    elif opcode == 0xB:
+        if dst_type == 'reg':
+            lines += [f"s = {value}", f"v = r[{dst}]"]
+            if flags:
+                lines.append(f"r[7] = (r[7] & 0xFF00) + {NZP_FLAGS} + {GEL_FLAGS}")
+            else:
+                lines.append(f"r[7] = (r[7] & 0xFF0F) + {GEL_FLAGS}")
+    elif opcode == 0xC:
+        lines.append("sp = r[5]")
+        lines += write("sp", "r[4]", ["r[5] = sp + 1"])
+        lines.append(f"r[4] = {src}")
+    elif opcode == 0xD:
+        lines.append(f"if not r[7] & 0x2: r[4] = {src}")
+    elif opcode == 0xE:
+        lines += ["r[5] -= 1", "r[4] = m[r[5]]"]
+    elif opcode == 0xF:
+        lines.append("r[7] += 0x100")
+
+    return lines
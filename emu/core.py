@@ -1,51 +1,175 @@
 #!/usr/bin/env python3
 import sys
 import argparse
-from mem import LLAMAMemory
-from cpu import LLAMACpu, CpuHalted
+try:
+    from .machine import Machine
+    from .cpu import RunResult
+    from .batch import load_manifest, run_batch
+    from .dev import ConsoleDevice, CONSOLE_START, CONSOLE_END
+    from .sym import load_symbols
+    from .debug import Debugger, console_handler
+    from .counters import load_costs
+except ImportError:
+    from machine import Machine
+    from cpu import RunResult
+    from batch import load_manifest, run_batch
+    from dev import ConsoleDevice, CONSOLE_START, CONSOLE_END
+    from sym import load_symbols
+    from debug import Debugger, console_handler
+    from counters import load_costs
 
 
 class Emulator(object):
     debug_mode = False
 
-    def __init__(self):
+    def __init__(self, argv=None):
         description = "LLAMA-16 Emulator"
         parser = argparse.ArgumentParser(description=description)
         parser.add_argument("program",
-                            default="",
+                            nargs="?",
                             help="input program to be ran")
         parser.add_argument("-d",
                             "--debug",
                             action="store_true",
                             help="print extra debugging infomation")
-        args = parser.parse_args()
+        parser.add_argument("--jit",
+                            action="store_true",
+                            help="translate basic blocks into Python functions")
+        parser.add_argument("--mmio",
+                            action="store_true",
+                            help="attach console input and output at 0xFFFE and 0xFFFF")
+        parser.add_argument("--trace",
+                            type=int,
+                            metavar="N",
+                            help="keep the last N instructions and print them if the program crashes")
+        parser.add_argument("--trace-file",
+                            metavar="FILE",
+                            help="save the --trace instructions to FILE when the emulator stops")
+        parser.add_argument("--profile",
+                            action="store_true",
+                            help="count executed instructions and print a profile when the emulator stops")
+        parser.add_argument("--sym",
+                            metavar="FILE",
+                            help="symbol table for --profile, the .SYM file next to the program by default")
+        parser.add_argument("--stats",
+                            action="store_true",
+                            help="count instructions, memory accesses and guest cycles "
+                                 "and print them when the emulator stops")
+        parser.add_argument("--costs",
+                            metavar="FILE",
+                            help="JSON cost table for --stats, see emu/counters.py")
+        parser.add_argument("--fusion-stats",
+                            action="store_true",
+                            help="print how often fused instruction pairs ran when the emulator stops")
+        parser.add_argument("-b",
+                            "--break",
+                            dest="breakpoints",
+                            action="append",
+                            default=[],
+                            metavar="LOCATION",
+                            help="stop at an address in hex or a label from the symbol table")
+        parser.add_argument("--watch",
+                            action="append",
+                            default=[],
+                            metavar="START[-END]",
+                            help="stop after writes to a memory address or range")
+        parser.add_argument("--rwatch",
+                            action="append",
+                            default=[],
+                            metavar="START[-END]",
+                            help="stop after reads of a memory address or range")
+        parser.add_argument("--batch",
+                            metavar="MANIFEST",
+                            help="run every program in a JSON manifest and print JSON line results")
+        parser.add_argument("-j",
+                            "--jobs",
+                            type=int,
+                            help="number of worker processes for --batch, one per core by default")
+        args = parser.parse_args(argv)
         if args.debug:
             self.debug_mode = True
 
-        self.memory = LLAMAMemory()
-        self.memory.load_program(args.program)
-        self.cpu = LLAMACpu(self.memory, self.debug_mode)
+        if args.batch:
+            run_batch(load_manifest(args.batch, args.jit), args.jobs)
+            sys.exit(0)
+        elif args.program is None:
+            parser.error("a program or --batch manifest is required")
+
+        self.machine = Machine(args.program, stdout=sys.stdout, jit=args.jit,
+                               debug_mode=self.debug_mode)
+        if args.mmio:
+            self.machine.attach(ConsoleDevice(), CONSOLE_START, CONSOLE_END)
+        if args.sym:
+            self.machine.symbols = load_symbols(args.sym)
+        if args.profile:
+            self.machine.start_profile()
+        if args.stats:
+            self.machine.start_stats(load_costs(args.costs) if args.costs else None)
+        self.trace = None
+        if args.trace or args.trace_file:
+            self.trace = self.machine.start_trace(args.trace or 1024)
+        self.memory = self.machine.memory
+        self.cpu = self.machine.cpu
+
+        debugger = None
+        if args.breakpoints or args.watch or args.rwatch:
+            debugger = Debugger(self.machine, console_handler)
+            for location in args.breakpoints:
+                debugger.add_breakpoint(location)
+            for watches, read, write in ((args.watch, False, True), (args.rwatch, True, False)):
+                for watch in watches:
+                    debugger.add_watchpoint(*watch.split('-', 1), read=read, write=write)
 
         try:
-            while True:
-                self.cpu.exec_next_instruction()
-        except CpuHalted:
+            if debugger is not None:
+                result = debugger.run()
+            else:
+                result = self.machine.run()
+        except KeyboardInterrupt as e:
+            self.dump_state()
+            raise e
+        finally:
+            if args.trace_file:
+                self.trace.save(args.trace_file)
+            if args.profile:
+                print(self.machine.profile_report(), file=sys.stderr)
+            if args.stats:
+                print(self.machine.counters.report(), file=sys.stderr)
+            if args.fusion_stats:
+                print(self.cpu.fusion.report(), file=sys.stderr)
+
+        if result.reason == RunResult.HALTED:
             print("CPU halted. Closing emulator...")
             if self.debug_mode:
                 self.dump_state()
             sys.exit(0)
-        except OverflowError:
+        elif result.reason in (RunResult.IO_WAIT, RunResult.INPUT_EXHAUSTED):
+            print("End of input reached. Closing emulator...")
+            if self.debug_mode:
+                self.dump_state()
+            sys.exit(1)
+        elif result.reason == RunResult.BREAKPOINT:
+            print("Stopped by the debugger. Closing emulator...")
+            sys.exit(1)
+        elif isinstance(result.error, OverflowError):
             print("OverflowError detected! Closing emulator...")
             if self.debug_mode:
                 self.dump_state()
+            elif self.trace is not None:
+                self.print_trace()
             sys.exit(1)
-        except (Exception, KeyboardInterrupt) as e:
+        else:
             self.dump_state()
-            raise e
+            raise result.error
 
     def dump_state(self):
-        self.cpu.dump_state()
-        self.memory.dump_mem_map()
+        if self.trace is not None:
+            self.print_trace()
+        self.machine.dump_state()
+
+    def print_trace(self):
+        print(f"======== Last {self.trace.count} Instructions ========")
+        print(self.trace.format())
 
 
 if __name__ == "__main__":
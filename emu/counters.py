@@ -0,0 +1,164 @@
+"""Guest cycle accounting and performance counters for LLAMA-16 programs.
+
+A CostTable gives every opcode a number of cycles, plus extra cycles for
+every memory access an instruction makes and every immediate or address
+word fetched after the instruction word. PerfCounters counts what a CPU
+executes and adds the costs up, so two versions of a routine can be
+compared by numbers that do not depend on the host.
+
+A cost table file is JSON like:
+
+    {"opcodes": {"call": 3, "ret": 3}, "memory": 2, "word": 1}
+
+where opcodes that are left out cost one cycle.
+"""
+import json
+try:
+    from .cpu import MNEMONICS
+except ImportError:
+    from cpu import MNEMONICS
+
+# Names of the counters returned by PerfCounters.totals(), in report order
+COUNTERS = ('instructions', 'cycles', 'memory_reads', 'memory_writes', 'pushes',
+            'pops', 'calls', 'returns', 'jnz_taken', 'jnz_not_taken')
+
+
+class CostTable(object):
+    """Cycles charged for each instruction.
+
+    Args:
+        opcodes: Cycles by mnemonic, for the opcodes that do not cost 1
+        memory: Extra cycles for each memory read or write
+        word: Extra cycles for each word after the instruction word
+    """
+
+    def __init__(self, opcodes=None, memory=1, word=1):
+        self.opcodes = [1] * 16
+        for mnemonic, cycles in (opcodes or {}).items():
+            self.opcodes[MNEMONICS.index(mnemonic)] = cycles
+        self.memory = memory
+        self.word = word
+
+    def cost(self, decoded):
+        reads, writes = memory_accesses(decoded)[:2]
+        return (self.opcodes[decoded.opcode] + self.memory * (reads + writes)
+                + self.word * (decoded.size - 1))
+
+
+def load_costs(filename):
+    """Read a CostTable from a JSON file."""
+    with open(filename, 'r') as file:
+        table = json.load(file)
+    return CostTable(table.get('opcodes'), table.get('memory', 1), table.get('word', 1))
+
+
+def memory_accesses(decoded):
+    """Return (reads, writes, pushes, pops) made by one run of an instruction.
+
+    Stack accesses count as reads and writes too. io strings count as a
+    single access however many words they span.
+    """
+    opcode = decoded.opcode
+    src_mem = int(decoded.src_type == 'mem_adr')
+    dst_mem = int(decoded.dst_type == 'mem_adr')
+    if opcode == 0x0:
+        return src_mem, dst_mem, 0, 0
+    elif opcode == 0x1:
+        # The destination nybble is 1 for IN, which stores to the source
+        if decoded.dst_reg == 0x1:
+            return 0, src_mem, 0, 0
+        return src_mem, 0, 0, 0
+    elif opcode == 0x2:
+        return src_mem, 1, 1, 0
+    elif opcode == 0x3:
+        return 1, src_mem, 0, 1
+    elif opcode in (0x4, 0x5, 0x8, 0x9):
+        return src_mem + dst_mem, dst_mem, 0, 0
+    elif opcode == 0xA:
+        return src_mem, dst_mem, 0, 0
+    elif opcode in (0x6, 0x7):
+        return src_mem, src_mem, 0, 0
+    elif opcode == 0xB:
+        # cmp does nothing at all with a memory destination
+        return (src_mem, 0, 0, 0) if not dst_mem else (0, 0, 0, 0)
+    elif opcode == 0xC:
+        return 0, 1, 1, 0
+    elif opcode == 0xE:
+        return 1, 0, 0, 1
+    return 0, 0, 0, 0
+
+
+class PerfCounters(object):
+    """Counts executed instructions and their cost. Add it to a CPU with
+    add_hook() after calling attach(cpu)."""
+
+    def __init__(self, costs=None):
+        self.costs = costs if costs is not None else CostTable()
+        # DecodedInstruction -> times run, totalled up by totals()
+        self._executed = {}
+        self._registers = None
+        self.jnz_taken = 0
+        # the last instruction recorded, whether it was a taken jnz, and the
+        # number of instructions recorded when the last run finished
+        self._last = None
+        self._last_taken = False
+        self._finished = 0
+
+    def attach(self, cpu):
+        self._registers = cpu.registers
+
+    def record(self, ip, decoded):
+        executed = self._executed
+        executed[decoded] = executed.get(decoded, 0) + 1
+        self._last = decoded
+        # jnz only reads the flags, so they tell whether it will jump
+        self._last_taken = decoded.opcode == 0xD and not self._registers[7] & 0x2
+        self.jnz_taken += self._last_taken
+
+    def finish(self, steps=None):
+        """Take back the last instruction recorded if it never ran, so the
+        counters agree with the steps of every run."""
+        recorded = sum(self._executed.values())
+        if steps is not None and recorded - self._finished > steps:
+            # It faulted, waited for input or hit a breakpoint, and is
+            # recorded again when the run is resumed
+            self._executed[self._last] -= 1
+            self.jnz_taken -= self._last_taken
+            recorded -= 1
+        self._finished = recorded
+        self._last = None
+
+    def clear(self):
+        self._executed.clear()
+        self.jnz_taken = 0
+        self._last = None
+        self._finished = 0
+
+    def totals(self):
+        """Return every counter in COUNTERS by name."""
+        totals = dict.fromkeys(COUNTERS, 0)
+        jnz = 0
+        for decoded, count in self._executed.items():
+            reads, writes, pushes, pops = memory_accesses(decoded)
+            totals['instructions'] += count
+            totals['cycles'] += count * self.costs.cost(decoded)
+            totals['memory_reads'] += count * reads
+            totals['memory_writes'] += count * writes
+            totals['pushes'] += count * pushes
+            totals['pops'] += count * pops
+            if decoded.opcode == 0xC:
+                totals['calls'] += count
+            elif decoded.opcode == 0xE:
+                totals['returns'] += count
+            elif decoded.opcode == 0xD:
+                jnz += count
+        totals['jnz_taken'] = self.jnz_taken
+        totals['jnz_not_taken'] = jnz - self.jnz_taken
+        return totals
+
+    def report(self):
+        """Return the counters as text."""
+        lines = ["======== LLAMA-16 Stats ========"]
+        for name, value in self.totals().items():
+            lines.append(f"{name.replace('_', ' '):<16} {value:>14}")
+        return "\n".join(lines)
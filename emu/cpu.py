@@ -1,4 +1,12 @@
-import ctypes
+import sys
+from bisect import bisect_right
+from functools import partial
+try:
+    from .codegen import emit_instruction, plain_write, sets_nzp_flags
+    from .stream import OutputSink, IoWait, InputExhausted, OVERFLOW, input_source
+except ImportError:
+    from codegen import emit_instruction, plain_write, sets_nzp_flags
+    from stream import OutputSink, IoWait, InputExhausted, OVERFLOW, input_source
 
 IP_START = 0x4000
 SP_START = 0xDFC0
@@ -9,34 +17,463 @@ RBP_REG = 6
 RFLAG_REG = 7
 
 
-def ushort(value):
-    return ctypes.c_ushort(value).value
+class CpuHalted(Exception):
+    pass
 
 
-class CpuHalted(Exception):
+class InvalidInstruction(Exception):
+    pass
+
+
+class StopExecution(Exception):
+    """Raised by a hook to stop run() before the instruction it was called for."""
     pass
 
 
+class RunResult(object):
+    """Why LLAMACpu.run returned and how many instructions it executed."""
+    HALTED = 'halted'
+    MAX_STEPS = 'max_steps'
+    IO_WAIT = 'io_wait'
+    INPUT_EXHAUSTED = 'input_exhausted'
+    # a hook raised StopExecution, which is returned as the error
+    BREAKPOINT = 'breakpoint'
+    FAULT = 'fault'
+    # only returned by Machine.run, which can also limit wall time
+    TIMEOUT = 'timeout'
+
+    def __init__(self, reason, steps, error=None):
+        self.reason = reason
+        self.steps = steps
+        self.error = error
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.reason!r}, {self.steps}, {self.error!r})"
+
+
+class DecodedInstruction(object):
+    """An instruction decoded once and cached by the address it was read from.
+
+    Holds everything needed to execute it again without touching the
+    instruction words in memory: the bound handler, the operand kinds, the
+    register encodings and the trailing immediate/address words.
+    """
+    __slots__ = ('execute', 'opcode', 'src_type', 'dst_type', 'src_reg',
+                 'dst_reg', 'src_word', 'dst_word', 'size', 'count')
+
+    def __init__(self, execute, opcode, src_type, dst_type, src_reg, dst_reg,
+                 src_word=None, dst_word=None, size=1):
+        self.execute = execute
+        self.opcode = opcode
+        self.src_type = src_type
+        self.dst_type = dst_type
+        self.src_reg = src_reg
+        self.dst_reg = dst_reg
+        self.src_word = src_word
+        self.dst_word = dst_word
+        self.size = size
+        # instructions run by execute()
+        self.count = 1
+
+
+class FusedInstruction(DecodedInstruction):
+    """Two instructions run by a single handler, cached by the first one's address."""
+    __slots__ = ('first', 'second')
+
+    def __init__(self, execute, first, second):
+        super().__init__(execute, first.opcode, first.src_type, first.dst_type,
+                         first.src_reg, first.dst_reg, first.src_word,
+                         first.dst_word, first.size + second.size)
+        self.count = 2
+        self.first = first
+        self.second = second
+
+
+class FusionStats(object):
+    """How many pairs of instructions were fused and how often they ran."""
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        # pair name like 'dec+jnz' -> number of addresses it was fused at
+        self.sites = {}
+        # pair name -> [times run], counted by the fused handlers themselves
+        self.executed = {}
+        # instructions run by LLAMACpu.run, fused or not
+        self.instructions = 0
+
+    @property
+    def fused(self):
+        """Number of instructions that ran as part of a fused pair."""
+        return 2 * sum(count for count, in self.executed.values())
+
+    def report(self):
+        instructions = self.instructions or 1
+        lines = ["======== LLAMA-16 Fusion ========",
+                 f"{self.instructions} instructions executed, {self.fused} "
+                 f"({100 * self.fused / instructions:.1f}%) of them in fused pairs", "",
+                 f"{'pair':<10} {'sites':>6} {'executed':>14}"]
+        pairs = sorted(self.executed, key=lambda name: self.executed[name][0], reverse=True)
+        for name in pairs:
+            lines.append(f"{name:<10} {self.sites[name]:>6} {self.executed[name][0]:>14}")
+        return "\n".join(lines)
+
+
+MNEMONICS = ['mv', 'io', 'push', 'pop', 'add', 'sub', 'inc', 'dec',
+             'and', 'or', 'not', 'cmp', 'call', 'jnz', 'ret', 'hlt']
+
+
+def _operand_type(encode, allow_imm):
+    if encode < 0x7:
+        return 'reg'
+    elif encode == 0xE and allow_imm:
+        return 'imm'
+    elif encode == 0xF:
+        return 'mem_adr'
+    raise InvalidInstruction
+
+
+def _trailing_words(opcode, src_type, dst_type, dst_encode):
+    """Return whether the source and destination operands are followed by a word."""
+    if opcode in (0xC, 0xD):
+        return True, False
+    elif opcode == 0x1:
+        if dst_encode == 0x1:
+            return src_type == 'mem_adr', False
+        elif dst_encode == 0x2:
+            return src_type in ('imm', 'mem_adr'), False
+        return False, False
+    elif opcode == 0x2:
+        return src_type in ('imm', 'mem_adr'), False
+    elif opcode in (0x3, 0x6, 0x7):
+        return src_type == 'mem_adr', False
+    elif opcode < 0xC:
+        return src_type in ('imm', 'mem_adr'), dst_type == 'mem_adr'
+    return False, False
+
+
+def _build_handler(opcode, src_type, dst_type):
+    name = f"{MNEMONICS[opcode]}_{src_type}_{dst_type}"
+    body = emit_instruction(opcode, src_type, dst_type, "src", "dst") or ["pass"]
+    if opcode == 0xF:
+        # Halting stops run() with one exception instead of a test every step
+        body.append("raise CpuHalted")
+    source = f"def {name}(r, m, w, src, dst):\n" + "".join(f"    {line}\n" for line in body)
+    namespace = {'CpuHalted': CpuHalted}
+    exec(compile(source, f"<{name}>", "exec"), namespace)
+    return namespace[name]
+
+
+def _build_handler_table():
+    """Map every (opcode, src, dst) nybble pattern to a specialized handler.
+
+    Entries are (handler, src_type, dst_type, src_word_used, dst_word_used),
+    or None for invalid operand encodings. io is handled by LLAMACpu._io, so
+    its entries carry no handler.
+    """
+    handlers = {}
+    table = [None] * 0x1000
+    for pattern in range(0x1000):
+        opcode = pattern >> 8
+        src_encode = (pattern & 0x00F0) >> 4
+        dst_encode = pattern & 0x000F
+        if opcode >= 0xC:
+            # call, jnz, ret and hlt do not use the operand type nybbles
+            src_type, dst_type = None, None
+        else:
+            try:
+                src_type = _operand_type(src_encode, True)
+                dst_type = _operand_type(dst_encode, False)
+            except InvalidInstruction:
+                continue
+
+        key = (opcode, src_type, dst_type)
+        if opcode != 0x1 and key not in handlers:
+            handlers[key] = _build_handler(*key)
+        table[pattern] = (handlers.get(key), src_type, dst_type) + \
+            _trailing_words(opcode, src_type, dst_type, dst_encode)
+    return table
+
+
+HANDLER_TABLE = _build_handler_table()
+
+
+def decode_instruction(read, address):
+    """Decode the instruction at address, reading words with read(address).
+
+    Returns a DecodedInstruction without a handler bound to execute, or
+    raises InvalidInstruction.
+    """
+    instruction = read(address)
+    entry = HANDLER_TABLE[((instruction & 0xF000) >> 4) | (instruction & 0x00FF)]
+    if entry is None:
+        raise InvalidInstruction(f"Invalid operand encoding in {hex(instruction)}")
+    handler, src_type, dst_type, src_word_used, dst_word_used = entry
+
+    size = 1
+    src_word, dst_word = None, None
+    if src_word_used:
+        src_word = read((address + size) & 0xFFFF)
+        size += 1
+    if dst_word_used:
+        dst_word = read((address + size) & 0xFFFF)
+        size += 1
+    return DecodedInstruction(None, (instruction & 0xF000) >> 12, src_type, dst_type,
+                              (instruction & 0x00F0) >> 4, instruction & 0x000F,
+                              src_word, dst_word, size)
+
+
+def reads_ip_early(decoded):
+    """Whether an instruction reads IP as its source and is followed by a word.
+
+    Operand words were originally fetched one at a time, so such an
+    instruction sees IP pointing just past the instruction word rather than
+    past the whole instruction. Every engine keeps that value.
+    """
+    return decoded.src_type == 'reg' and decoded.src_reg == RIP_REG and decoded.size > 1
+
+
+# Instructions that can be fused: they can not fault, store to memory or
+# jump, so running the pair at once is the same as running it in order.
+# The second of a pair may also be a jnz.
+FUSE_FIRST = (0x0, 0x4, 0x5, 0x6, 0x7, 0x8, 0x9, 0xA, 0xB)
+FUSE_SECOND = FUSE_FIRST + (0xD,)
+
+# source -> compiled factory building a fused handler, shared by all CPUs
+_fused_factories = {}
+
+
+def _build_fused(source, registers, memory, executed):
+    factory = _fused_factories.get(source)
+    if factory is None:
+        namespace = {}
+        exec(compile(source, "<fused>", "exec"), namespace)
+        factory = _fused_factories[source] = namespace['fused']
+    return factory(registers, memory, executed)
+
+
 class LLAMACpu(object):
     debug_mode = False
+    # Run common pairs of instructions with one handler, see _fuse()
+    fuse = True
 
-    def __init__(self, memory, debug_mode=False):
+    def __init__(self, memory, debug_mode=False, stdin=None, stdout=None):
         if debug_mode:
             self.debug_mode = True
         self.memory = memory
+        # io reads from an InputSource made from stdin, see input_source(),
+        # and writes through a buffer to stdout, or sys.stdout when it is None
+        self.stdin = stdin
+        self.output = OutputSink(stdout)
         self.registers = [0, 0, 0, 0, IP_START, SP_START, BP_START, 0]
+        # Objects whose record(ip, decoded) is called before every
+        # instruction and finish(steps) when run() returns, see add_hook()
+        self.hooks = []
+        self.trace = None
+        self.fusion = FusionStats()
+        # address -> DecodedInstruction, plus a map of every word covered by
+        # a cached instruction so _mem_write can invalidate in O(1)
+        self._decode_cache = {}
+        self._code_words = bytearray(memory.mem_size)
+        # address -> FusedInstruction, or the DecodedInstruction when the
+        # instruction there is not fused, for the fast loop in _execute
+        self._fused_cache = {}
+        # targets of the jnz and call instructions decoded so far and the
+        # addresses calls return to, which never start the second half of a pair
+        self._jump_targets = set()
 
     def exec_next_instruction(self):
         if self.debug_mode:
             self.dump_state()
         ip = self._get_ip()
-        self._increment_rip()
-        instruction = self._mem_read(ip)
-        self._decode_instruction(instruction)
+        decoded = self._decode_cache.get(ip)
+        if decoded is None:
+            decoded = self._predecode(ip)
+        for hook in self.hooks:
+            hook.record(ip, decoded)
+        self.registers[RIP_REG] = (ip + decoded.size) & 0xFFFF
+        decoded.execute()
+
+    @property
+    def stdin(self):
+        return self._input
+
+    @stdin.setter
+    def stdin(self, stdin):
+        self._input = input_source(stdin)
+
+    @property
+    def stdout(self):
+        return self.output.stream
+
+    @stdout.setter
+    def stdout(self, stream):
+        self.output.stream = stream
+
+    def run(self, max_steps=None):
+        """Execute instructions until the CPU stops or max_steps have run.
+
+        Returns a RunResult. On IO_WAIT, INPUT_EXHAUSTED, BREAKPOINT and
+        FAULT, IP is left pointing at the instruction that stopped, so a
+        waiting CPU can be run again once input is available. Buffered output
+        is flushed before returning.
+        """
+        try:
+            result = self._execute(max_steps)
+            self.fusion.instructions += result.steps
+            return result
+        finally:
+            self.output.flush()
+
+    def _execute(self, max_steps):
         if self.registers[RFLAG_REG] & 0x0100:
-            raise CpuHalted
+            return RunResult(RunResult.HALTED, 0)
+        if self.debug_mode:
+            return self._run_hooked(max_steps, lambda ip, decoded: self.dump_state())
+        if self.hooks:
+            return self._run_with_hooks(max_steps)
+
+        registers = self.registers
+        if self.fuse:
+            cache = self._fused_cache
+            predecode = self._predecode_fused
+        else:
+            cache = self._decode_cache
+            predecode = self._predecode
+        limit = max_steps if max_steps is not None else float('inf')
+        steps = 0
+        ip = registers[RIP_REG]
+        try:
+            # Stop one short of the limit so a fused pair can not overrun it
+            while steps < limit - 1:
+                ip = registers[4]
+                decoded = cache.get(ip)
+                if decoded is None:
+                    decoded = predecode(ip)
+                registers[4] = (ip + decoded.size) & 0xFFFF
+                decoded.execute()
+                steps += decoded.count
+            if steps < limit:
+                ip = registers[4]
+                decoded = self._decode_cache.get(ip)
+                if decoded is None:
+                    decoded = self._predecode(ip)
+                registers[4] = (ip + decoded.size) & 0xFFFF
+                decoded.execute()
+                steps += 1
+        except CpuHalted:
+            return RunResult(RunResult.HALTED, steps + 1)
+        except Exception as error:
+            return self._stopped(ip, steps, error)
+        return RunResult(RunResult.MAX_STEPS, steps)
+
+    def _run_hooked(self, max_steps, hook):
+        # Same as run() but calls hook(ip, decoded) before every instruction
+        registers = self.registers
+        limit = max_steps if max_steps is not None else float('inf')
+        steps = 0
+        ip = registers[RIP_REG]
+        try:
+            while steps < limit:
+                ip = registers[RIP_REG]
+                decoded = self._decode_cache.get(ip)
+                if decoded is None:
+                    decoded = self._predecode(ip)
+                hook(ip, decoded)
+                registers[RIP_REG] = (ip + decoded.size) & 0xFFFF
+                decoded.execute()
+                steps += 1
+        except CpuHalted:
+            return RunResult(RunResult.HALTED, steps + 1)
+        except Exception as error:
+            return self._stopped(ip, steps, error)
+        return RunResult(RunResult.MAX_STEPS, steps)
+
+    def _run_with_hooks(self, max_steps):
+        hooks = list(self.hooks)
+        if len(hooks) == 1:
+            record = hooks[0].record
+        else:
+            def record(ip, decoded):
+                for hook in hooks:
+                    hook.record(ip, decoded)
+        result = None
+        try:
+            result = self._run_hooked(max_steps, record)
+            return result
+        finally:
+            # The instruction that stopped a run was recorded but never ran
+            steps = result.steps if result is not None else None
+            for hook in hooks:
+                hook.finish(steps)
+
+    def _stopped(self, ip, steps, error):
+        self.registers[RIP_REG] = ip
+        if isinstance(error, StopExecution):
+            return RunResult(RunResult.BREAKPOINT, steps, error)
+        if isinstance(error, InputExhausted):
+            return RunResult(RunResult.INPUT_EXHAUSTED, steps)
+        if isinstance(error, IoWait):
+            return RunResult(RunResult.IO_WAIT, steps)
+        return RunResult(RunResult.FAULT, steps, error)
+
+    def add_hook(self, hook):
+        """Call hook.record(ip, decoded) before every instruction from now on,
+        and hook.finish(steps) with the number of instructions run when run()
+        returns.
+
+        While any hook is added run() uses the slower _run_hooked loop, and
+        LLAMABlockCpu interprets instead of running translated blocks.
+        """
+        self.hooks.append(hook)
+
+    def remove_hook(self, hook):
+        self.hooks.remove(hook)
+
+    def set_trace(self, trace):
+        """Record every instruction run from now on in a TraceBuffer, or stop
+        tracing when trace is None."""
+        if self.trace is not None:
+            self.remove_hook(self.trace)
+        if trace is not None:
+            trace.attach(self)
+            self.add_hook(trace)
+        self.trace = trace
+
+    def reset(self):
+        """Put the registers back to their power on values."""
+        self.registers[:] = [0, 0, 0, 0, IP_START, SP_START, BP_START, 0]
+        self.flush_decode_cache()
+
+    def snapshot(self):
+        return tuple(self.registers)
+
+    def restore(self, snapshot):
+        self.registers[:] = snapshot
+
+    def flush_decode_cache(self):
+        """Forget every decoded instruction, e.g. after memory was reloaded."""
+        self._decode_cache.clear()
+        self._fused_cache.clear()
+        self._jump_targets.clear()
+        self._code_words = bytearray(len(self._code_words))
+
+    def drop_changed_code(self, words):
+        """Forget decoded instructions whose words differ from words.
+
+        Used before memory is replaced by a snapshot, so code that is the same
+        in both does not have to be decoded again.
+        """
+        memory = self.memory.memory
+        for cache in (self._decode_cache, self._fused_cache):
+            for address, decoded in list(cache.items()):
+                end = address + decoded.size
+                if end > len(memory) or memory[address:end] != words[address:end]:
+                    del cache[address]
 
     def dump_state(self):
+        self.output.flush()
         print("======== LLAMA-16 CPU State ========")
         print(f"REG A: {hex(self.registers[0])}")
         print(f"REG B: {hex(self.registers[1])}")
@@ -73,189 +510,207 @@ class LLAMACpu(object):
 
         return set_flags
 
-    def _increment_rip(self):
-        self.registers[RIP_REG] = ushort(self.registers[RIP_REG] + 0x1)
-
     def _mem_read(self, address):
-        # Will need to be refactored for memory mapped I/O
         return self.memory.mem_read(address)
 
     def _mem_write(self, address, value):
-        self.memory.mem_write(address, ushort(value))
+        self.memory.mem_write(address, value & 0xFFFF)
+        if self._code_words[address]:
+            return self._invalidate(address)
+        return False
+
+    def _invalidate(self, address):
+        # An instruction is at most three words long, so only entries
+        # starting up to two words before the write can cover it.
+        invalidated = False
+        self._code_words[address] = 0
+        for start in (address, address - 1, address - 2):
+            start &= 0xFFFF
+            decoded = self._decode_cache.get(start)
+            if decoded is not None and (address - start) & 0xFFFF < decoded.size:
+                del self._decode_cache[start]
+                invalidated = True
+        # Fused pairs are up to six words long
+        for offset in range(6):
+            start = (address - offset) & 0xFFFF
+            decoded = self._fused_cache.get(start)
+            if decoded is not None and offset < decoded.size:
+                del self._fused_cache[start]
+                invalidated = True
+        return invalidated
 
     def _reg_read(self, register):
-        if register == 'a':
-            return self.registers[0]
-        elif register == 'b':
-            return self.registers[1]
-        elif register == 'c':
-            return self.registers[2]
-        elif register == 'd':
-            return self.registers[3]
-        elif register == 'ip':
-            return self.registers[RIP_REG]
-        elif register == 'sp':
-            return self.registers[RSP_REG]
-        elif register == 'bp':
-            return self.registers[RBP_REG]
+        return self.registers[register]
 
     def _reg_write(self, register, value):
-        if register == 'a':
-            self.registers[0] = ushort(value)
-        elif register == 'b':
-            self.registers[1] = ushort(value)
-        elif register == 'c':
-            self.registers[2] = ushort(value)
-        elif register == 'd':
-            self.registers[3] = ushort(value)
-        elif register == 'ip':
-            self.registers[RIP_REG] = ushort(value)
-        elif register == 'sp':
-            self.registers[RSP_REG] = ushort(value)
-        elif register == 'bp':
-            self.registers[RBP_REG] = ushort(value)
+        self.registers[register] = value & 0xFFFF
 
     def _get_ip(self):
         return self.registers[RIP_REG]
 
-    def _update_flags(self, register, compare_flags=0x0):
-        # 0000 000H 0GEL 0NZP
-        self.registers[RFLAG_REG] = self.registers[RFLAG_REG] & 0xFFF0
-
-        value = self._reg_read(register)
-        if value == 0:
-            self.registers[RFLAG_REG] = self.registers[RFLAG_REG] + 0x2
-        elif value > 0x7FFF:
-            self.registers[RFLAG_REG] = self.registers[RFLAG_REG] + 0x4
+    def _predecode(self, address):
+        decoded = self._decode_at(address)
+        self._decode_cache[address] = decoded
+        for offset in range(decoded.size):
+            self._code_words[(address + offset) & 0xFFFF] = 1
+        if decoded.opcode == 0xC:
+            self._add_jump_target((address + decoded.size) & 0xFFFF)
+        if decoded.opcode in (0xC, 0xD):
+            self._add_jump_target(decoded.src_word)
+        return decoded
+
+    def _predecode_fused(self, address):
+        decoded = self._decode_cache.get(address)
+        if decoded is None:
+            decoded = self._predecode(address)
+        fused = self._fuse(address, decoded)
+        if fused is not None:
+            decoded = fused
+        self._fused_cache[address] = decoded
+        return decoded
+
+    def _fuse(self, address, first):
+        """Return a FusedInstruction running first and the instruction after
+        it, or None when the pair can not be fused.
+
+        Entries are looked up by the address in IP, so a jump to the second
+        instruction of a pair runs it on its own either way. Known jump
+        targets are still never fused into the middle of a pair, so that
+        every jump into a loop takes the fast path.
+        """
+        second_address = address + first.size
+        if (second_address > 0xFFFF or second_address in self._jump_targets
+                or not self._fusable(first, FUSE_FIRST)):
+            return None
+        second = self._decode_cache.get(second_address)
+        if second is None:
+            try:
+                second = self._predecode(second_address)
+            except InvalidInstruction:
+                return None
+        # Decoding the second may have found it to be a target too
+        if second_address in self._jump_targets or not self._fusable(second, FUSE_SECOND):
+            return None
+
+        name = f"{MNEMONICS[first.opcode]}+{MNEMONICS[second.opcode]}"
+        # NZP set by the first is dead when the second sets it again
+        keep_flags = not sets_nzp_flags(second.opcode, second.src_type, second.dst_type)
+        body = ["n[0] += 1"]
+        body += emit_instruction(first.opcode, first.src_type, first.dst_type,
+                                 self._operand(first.src_type, first.src_reg, first.src_word),
+                                 self._operand(first.dst_type, first.dst_reg, first.dst_word),
+                                 plain_write, keep_flags)
+        body += emit_instruction(second.opcode, second.src_type, second.dst_type,
+                                 self._operand(second.src_type, second.src_reg, second.src_word),
+                                 self._operand(second.dst_type, second.dst_reg, second.dst_word))
+        source = "def fused(r, m, n):\n    def run():\n"
+        source += "".join(f"        {line}\n" for line in body) + "    return run\n"
+
+        self.fusion.sites[name] = self.fusion.sites.get(name, 0) + 1
+        executed = self.fusion.executed.setdefault(name, [0])
+        execute = _build_fused(source, self.registers, self.memory.memory, executed)
+        return FusedInstruction(execute, first, second)
+
+    def _fusable(self, decoded, opcodes):
+        # Only registers other than IP, immediates and plain memory reads
+        if decoded.opcode not in opcodes or self._uses_device(decoded):
+            return False
+        if decoded.opcode == 0xD:
+            return True
+        if decoded.src_type == 'reg' and decoded.src_reg == RIP_REG:
+            return False
+        if decoded.opcode in (0x6, 0x7):
+            return decoded.src_type == 'reg'
+        return decoded.dst_type == 'reg' and decoded.dst_reg != RIP_REG
+
+    def _add_jump_target(self, target):
+        if target in self._jump_targets:
+            return
+        self._jump_targets.add(target)
+        # Split a pair already fused across the new target
+        for offset in (1, 2, 3):
+            start = (target - offset) & 0xFFFF
+            decoded = self._fused_cache.get(start)
+            if decoded is not None and decoded.count == 2 and decoded.first.size == offset:
+                del self._fused_cache[start]
+
+    def _operand(self, op_type, register, word):
+        # An operand as a Python expression for the codegen templates
+        if op_type == 'reg':
+            return str(register)
+        if word is not None:
+            return hex(word)
+        return None
+
+    def _decode_at(self, address):
+        # Instructions are fetched from memory itself, so devices such as
+        # watchpoints and consoles only ever see the accesses they make
+        decoded = decode_instruction(self.memory.memory.__getitem__, address)
+        handler = HANDLER_TABLE[(decoded.opcode << 8) | (decoded.src_reg << 4) | decoded.dst_reg][0]
+        if handler is None:
+            decoded.execute = partial(self._io, decoded)
         else:
-            self.registers[RFLAG_REG] = self.registers[RFLAG_REG] + 0x1
-
-        if compare_flags != 0x0:
-            self.registers[RFLAG_REG] = self.registers[RFLAG_REG] & 0xFF0F
-            self.registers[RFLAG_REG] = self.registers[RFLAG_REG] + compare_flags
-
-    def _decode_instruction(self, instruction):
-        opcode = (instruction & 0xF000) >> 12
-
-        if opcode == 0x0:
-            self._mv(instruction)
-        elif opcode == 0x1:
-            self._io(instruction)
-        elif opcode == 0x2:
-            self._push(instruction)
-        elif opcode == 0x3:
-            self._pop(instruction)
-        elif opcode == 0x4:
-            self._add(instruction)
-        elif opcode == 0x5:
-            self._sub(instruction)
-        elif opcode == 0x6:
-            self._inc(instruction)
-        elif opcode == 0x7:
-            self._dec(instruction)
-        elif opcode == 0x8:
-            self._and(instruction)
-        elif opcode == 0x9:
-            self._or(instruction)
-        elif opcode == 0xA:
-            self._not(instruction)
-        elif opcode == 0xB:
-            self._cmp(instruction)
-        elif opcode == 0xC:
-            self._call(instruction)
-        elif opcode == 0xD:
-            self._jnz(instruction)
-        elif opcode == 0xE:
-            self._ret()
-        elif opcode == 0xF:
-            self._hlt()
-
-    def _get_op_types(self, instruction):
-        src_encode = (instruction & 0x00F0) >> 4
-        dst_encode = instruction & 0x000F
-        if src_encode < 0x7:
-            src_type = 'reg'
-        elif src_encode == 0xE:
-            src_type = 'imm'
-        elif src_encode == 0xF:
-            src_type = 'mem_adr'
-
-        if dst_encode < 0x7:
-            dst_type = 'reg'
-        elif dst_encode == 0xF:
-            dst_type = 'mem_adr'
-
-        return (src_type, dst_type)
-
-    def _get_register(self, encode):
-        if encode == 0:
-            return 'a'
-        elif encode == 1:
-            return 'b'
-        elif encode == 2:
-            return 'c'
-        elif encode == 3:
-            return 'd'
-        elif encode == 4:
-            return 'ip'
-        elif encode == 5:
-            return 'sp'
-        elif encode == 6:
-            return 'bp'
-
-    def _get_next_word(self):
-        word = self._mem_read(self.registers[RIP_REG])
-        self._increment_rip()
-        return word
+            src_type, dst_type = decoded.src_type, decoded.dst_type
+            src = decoded.src_reg if src_type == 'reg' else decoded.src_word
+            dst = decoded.dst_reg if dst_type == 'reg' else decoded.dst_word
+            if reads_ip_early(decoded):
+                # IP is a constant here, so run it as an immediate
+                handler = HANDLER_TABLE[(decoded.opcode << 8) | 0xE0 | decoded.dst_reg][0]
+                src = (address + 1) & 0xFFFF
+            # Stores always go through the memory bus, reads only need to
+            # when they may hit a device
+            memory = self.memory.view if self._uses_device(decoded) else self.memory.memory
+            decoded.execute = partial(handler, self.registers, memory,
+                                      self._mem_write, src, dst)
+        return decoded
+
+    def _uses_device(self, decoded):
+        """Whether an instruction may access a device attached to memory.
+
+        Operand addresses are fixed, so they are checked here once. pop and
+        ret read through SP, which could point anywhere.
+        """
+        if not self.memory.devices:
+            return False
+        if decoded.opcode in (0x3, 0xE):
+            return True
+        device_at = self.memory.device_at
+        return ((decoded.src_type == 'mem_adr' and device_at(decoded.src_word) is not None)
+                or (decoded.dst_type == 'mem_adr' and device_at(decoded.dst_word) is not None))
 
     def _twos(self, value):
         if (value & (1 << 15)) != 0:
             value = value - (1 << 16)
         return value
 
-    def _mv(self, instruction):
-        src_type, dst_type = self._get_op_types(instruction)
-        if src_type == 'imm':
-            src = self._get_next_word()
-        elif src_type == 'mem_adr':
-            address = self._get_next_word()
-            src = self._mem_read(address)
-        elif src_type == 'reg':
-            register = self._get_register((instruction & 0x00F0) >> 4)
-            src = self._reg_read(register)
-
-        if dst_type == 'mem_adr':
-            address = self._get_next_word()
-            self._mem_write(address, src)
-        elif dst_type == 'reg':
-            register = self._get_register((instruction & 0x000F))
-            self._reg_write(register, src)
-
-    def _io(self, instruction):
+    def _read_input(self):
+        # Prompts have to be visible before waiting for an answer
+        self.output.flush()
+        value = self._input.next_value()
+        if value is OVERFLOW:
+            raise OverflowError
+        return value
+
+    def _io(self, decoded):
         # dst_type will always return as register since the last nybble
         # can only be 1 for IN or 2 for OUT
-        src_type, dst_type = self._get_op_types(instruction)
-        dst_encode = (instruction & 0x000F)
+        src_type = decoded.src_type
+        dst_encode = decoded.dst_reg
         if dst_encode == 0x1:
             # Read in input and write out src
-            inp = input('\0')
-            try:
-                data = int(inp)
-                isInt = True
-                if (data > 32767 or data < -32768):
-                    raise OverflowError
-            except OverflowError:
-                raise OverflowError
-            except ValueError:
+            inp = self._read_input()
+            isInt = isinstance(inp, int)
+            if isInt:
+                data = inp
+            else:
                 # Input is a string of characters
-                isInt = False
                 if len(inp) % 2 == 0:
                     data = inp + '\0\0'
                 else:
                     data = inp + '\0'
 
             if src_type == 'reg':
-                register = self._get_register(((instruction & 0x00F0) >> 4))
+                register = decoded.src_reg
                 if isInt:
                     self._reg_write(register, data)
                 else:
@@ -264,7 +719,7 @@ class LLAMACpu(object):
                     data = (ord(inp[0]) << 8) + ord(inp[1])
                     self._reg_write(register, data)
             elif src_type == 'mem_adr':
-                address = self._get_next_word()
+                address = decoded.src_word
                 if isInt:
                     self._mem_write(address, data)
                 else:
@@ -277,228 +732,292 @@ class LLAMACpu(object):
         elif dst_encode == 0x2:
             # Read src and write out to standard out
             if src_type == 'imm':
-                word = self._get_next_word()
-                data = self._twos(word)
-                print(data, end='')
+                data = self._twos(decoded.src_word)
+                self.output.write(str(data))
             elif src_type == 'reg':
-                register = self._get_register((instruction & 0x00F0) >> 4)
+                register = decoded.src_reg
                 word = self._reg_read(register)
                 data = self._twos(word)
-                print(data, end='')
+                self.output.write(str(data))
             elif src_type == 'mem_adr':
-                address = self._get_next_word()
-                terminated = False
-                while not terminated:
-                    word = self._mem_read(address)
-                    first = chr(word & 0x00FF)
-                    second = chr((word & 0xFF00) >> 8)
-                    print(f"{first}{second}", end='')
-                    address += 1
-                    if first == '\0' or second == '\0':
-                        terminated = True
-
-    def _push(self, instruction):
-        src_type, dst_type = self._get_op_types(instruction)
-        if src_type == 'imm':
-            value = self._get_next_word()
-        elif src_type == 'mem_adr':
-            address = self._get_next_word()
-            value = self._mem_read(address)
-        elif src_type == 'reg':
-            register = self._get_register((instruction & 0x00F0) >> 4)
-            value = self._reg_read(register)
-
-        self._mem_write(self.registers[RSP_REG], value)
-        self.registers[RSP_REG] += 0x1
-
-    def _pop(self, instruction):
-        self.registers[RSP_REG] -= 0x1
-        value = self._mem_read(self.registers[RSP_REG])
-
-        src_type, dst_type = self._get_op_types(instruction)
-        if src_type == 'mem_adr':
-            address = self._get_next_word()
-            self._mem_write(address, value)
-        elif src_type == 'reg':
-            register = self._get_register((instruction & 0x00F0) >> 4)
-            self._reg_write(register, value)
-
-    def _add(self, instruction):
-        src_type, dst_type = self._get_op_types(instruction)
-        if src_type == 'imm':
-            src = self._get_next_word()
-        elif src_type == 'mem_adr':
-            address = self._get_next_word()
-            src = self._mem_read(address)
-        elif src_type == 'reg':
-            register = self._get_register((instruction & 0x00F0) >> 4)
-            src = self._reg_read(register)
-
-        if dst_type == 'mem_adr':
-            address = self._get_next_word()
-            dst = self._mem_read(address)
-            dst = dst + src
-            self._mem_write(address, dst)
-        elif dst_type == 'reg':
-            register = self._get_register((instruction & 0x000F))
-            dst = self._reg_read(register)
-            dst = dst + src
-            self._reg_write(register, dst)
-            self._update_flags(register)
-
-    def _sub(self, instruction):
-        src_type, dst_type = self._get_op_types(instruction)
-        if src_type == 'imm':
-            src = self._get_next_word()
-        elif src_type == 'mem_adr':
-            address = self._get_next_word()
-            src = self._mem_read(address)
-        elif src_type == 'reg':
-            register = self._get_register((instruction & 0x00F0) >> 4)
-            src = self._reg_read(register)
-
-        if dst_type == 'mem_adr':
-            address = self._get_next_word()
-            dst = self._mem_read(address)
-            dst = dst - src
-            self._mem_write(address, dst)
-        elif dst_type == 'reg':
-            register = self._get_register((instruction & 0x000F))
-            dst = self._reg_read(register)
-            dst = dst - src
-            self._reg_write(register, dst)
-            self._update_flags(register)
-
-    def _inc(self, instruction):
-        src_type, dst_type = self._get_op_types(instruction)
-        if src_type == 'mem_adr':
-            address = self._get_next_word()
-            value = self.mem_read(address)
-            self.mem_write(address, value + 1)
-        elif src_type == 'reg':
-            register = self._get_register((instruction & 0x00F0) >> 4)
-            value = self._reg_read(register)
-            self._reg_write(register, value + 1)
-            self._update_flags(register)
-
-    def _dec(self, instruction):
-        src_type, dst_type = self._get_op_types(instruction)
-        if src_type == 'mem_adr':
-            address = self._get_next_word()
-            value = self.mem_read(address)
-            self.mem_write(address, value - 1)
-        elif src_type == 'reg':
-            register = self._get_register((instruction & 0x00F0) >> 4)
-            value = self._reg_read(register)
-            self._reg_write(register, value - 1)
-            self._update_flags(register)
-
-    def _and(self, instruction):
-        src_type, dst_type = self._get_op_types(instruction)
-        if src_type == 'imm':
-            src = self._get_next_word()
-        elif src_type == 'mem_adr':
-            address = self._get_next_word()
-            src = self._mem_read(address)
-        elif src_type == 'reg':
-            register = self._get_register((instruction & 0x00F0) >> 4)
-            src = self._reg_read(register)
-
-        if dst_type == 'mem_adr':
-            address = self._get_next_word()
-            dst = self._mem_read(address)
-            dst = dst & src
-            self._mem_write(address, dst)
-        elif dst_type == 'reg':
-            register = self._get_register((instruction & 0x000F))
-            dst = self._reg_read(register)
-            dst = dst & src
-            self._reg_write(register, dst)
-            self._update_flags(register)
-
-    def _or(self, instruction):
-        src_type, dst_type = self._get_op_types(instruction)
-        if src_type == 'imm':
-            src = self._get_next_word()
-        elif src_type == 'mem_adr':
-            address = self._get_next_word()
-            src = self._mem_read(address)
-        elif src_type == 'reg':
-            register = self._get_register((instruction & 0x00F0) >> 4)
-            src = self._reg_read(register)
-
-        if dst_type == 'mem_adr':
-            address = self._get_next_word()
-            dst = self._mem_read(address)
-            dst = dst | src
-            self._mem_write(address, dst)
-        elif dst_type == 'reg':
-            register = self._get_register((instruction & 0x00F))
-            dst = self._reg_read(register)
-            dst = dst | src
-            self._reg_write(register, dst)
-            self._update_flags(register)
-
-    def _not(self, instruction):
-        src_type, dst_type = self._get_op_types(instruction)
-        if src_type == 'imm':
-            src = self._get_next_word()
-        elif src_type == 'mem_adr':
-            address = self._get_next_word()
-            src = self._mem_read(address)
-        elif src_type == 'reg':
-            register = self._get_register((instruction & 0x00F0) >> 4)
-            src = self._reg_read(register)
-
-        if dst_type == 'mem_adr':
-            address = self._get_next_word()
-            self._mem_write(address, ~src)
-        elif dst_type == 'reg':
-            register = self._get_register((instruction & 0x000F))
-            self._reg_write(register, ~src)
-            self._update_flags(register)
-
-    def _cmp(self, instruction):
-        # 0000 000H 0GEL 0NZP
-        src_type, dst_type = self._get_op_types(instruction)
-        if src_type == 'imm':
-            src = self._get_next_word()
-        elif src_type == 'mem_adr':
-            address = self._get_next_word()
-            src = self._mem_read(address)
-        elif src_type == 'reg':
-            register = self._get_register((instruction & 0x00F0) >> 4)
-            src = self._reg_read(register)
-
-        if dst_type == 'mem_adr':
-            address = self._get_next_word()
-            dst = self._mem_read(address)
-        elif dst_type == 'reg':
-            register = self._get_register((instruction & 0x000F))
-            dst = self._reg_read(register)
-
-            if src < dst:
-                self._update_flags(register, 0x0010)
-            elif src == dst:
-                self._update_flags(register, 0x0020)
-            elif src > dst:
-                self._update_flags(register, 0x0040)
-
-    def _call(self, instruction):
-        sub_routine = self._get_next_word()
-        self._mem_write(self.registers[RSP_REG], self.registers[RIP_REG])
-        self.registers[RSP_REG] += 0x1
-        self.registers[RIP_REG] = sub_routine
-
-    def _ret(self):
-        self.registers[RSP_REG] -= 0x1
-        self.registers[RIP_REG] = self._mem_read(self.registers[RSP_REG])
-
-    def _jnz(self, instruction):
-        flags = self.registers[RFLAG_REG]
-        address = self._get_next_word()
-        if (flags & 0x0002) != 0x2:
-            self.registers[RIP_REG] = ushort(address)
-
-    def _hlt(self):
-        self.registers[RFLAG_REG] = self.registers[RFLAG_REG] + 0x100
+                self.output.write(self._read_string(decoded.src_word))
+
+    def _read_string(self, address):
+        # Both characters of every word up to and including the one holding
+        # the terminating NUL, low byte first
+        if self.memory.devices or sys.byteorder != 'little':
+            return self._read_string_words(address)
+        with memoryview(self.memory.memory).cast('B') as view:
+            start = 2 * address
+            chunk = 64
+            while True:
+                data = bytes(view[start:start + chunk])
+                end = data.find(0)
+                if end >= 0:
+                    return data[:(end | 1) + 1].decode('latin-1')
+                if start + chunk >= len(view):
+                    # Ran off the end of memory like the word by word loop
+                    raise IndexError("array index out of range")
+                chunk *= 4
+
+    def _read_string_words(self, address):
+        characters = []
+        terminated = False
+        while not terminated:
+            word = self._mem_read(address)
+            first = chr(word & 0x00FF)
+            second = chr((word & 0xFF00) >> 8)
+            characters.append(f"{first}{second}")
+            address += 1
+            if first == '\0' or second == '\0':
+                terminated = True
+        return ''.join(characters)
+
+
+class TranslatedBlock(object):
+    __slots__ = ('start', 'end', 'last', 'length', 'run', 'links', 'valid',
+                 'addresses', 'lines')
+
+    def __init__(self, start, end, last, length, run, addresses, lines):
+        self.start = start
+        self.end = end
+        # address of the final instruction, the only one that may do io or
+        # access a device
+        self.last = last
+        self.length = length
+        self.run = run
+        # exit address -> following block, filled in as the blocks are chained
+        self.links = {}
+        self.valid = True
+        # address of every instruction and the source line its code starts on
+        self.addresses = addresses
+        self.lines = lines
+
+    def failed_at(self, traceback):
+        """Return the index of the instruction that raised an exception, or
+        None when it was not raised while running this block."""
+        code = self.run.__code__
+        while traceback is not None:
+            if traceback.tb_frame.f_code is code:
+                return bisect_right(self.lines, traceback.tb_lineno) - 1
+            traceback = traceback.tb_next
+        return None
+
+
+class LLAMABlockCpu(LLAMACpu):
+    """Executes straight-line runs of instructions as generated Python functions.
+
+    A block runs from its start address up to and including the first io,
+    call, jnz, ret, hlt, write to IP or instruction that may access a
+    device. Blocks are cached by start address and thrown away when memory
+    inside them is written.
+    """
+    MAX_BLOCK_LENGTH = 64
+
+    def __init__(self, memory, debug_mode=False, stdin=None, stdout=None):
+        super().__init__(memory, debug_mode, stdin, stdout)
+        self._block_cache = {}
+        self._block = None
+
+    def exec_next_block(self):
+        if self.debug_mode:
+            # dump_state needs to be called between every instruction
+            self.exec_next_instruction()
+            return
+
+        self._next_block(self.registers[RIP_REG]).run()
+        if self.registers[RFLAG_REG] & 0x0100:
+            raise CpuHalted
+
+    def _execute(self, max_steps):
+        """Execute translated blocks until the CPU stops or max_steps have run.
+
+        When the step budget ends inside a block the remaining instructions
+        are interpreted one at a time. A fault inside a block stops at the
+        instruction that raised it, like the interpreter does.
+        """
+        registers = self.registers
+        if self.debug_mode or self.hooks or registers[RFLAG_REG] & 0x0100:
+            return super()._execute(max_steps)
+
+        limit = max_steps if max_steps is not None else float('inf')
+        steps = 0
+        start = registers[RIP_REG]
+        block = None
+        try:
+            while True:
+                start = registers[RIP_REG]
+                block = self._next_block(start)
+                if steps + block.length > limit:
+                    break
+                steps += block.run()
+                if registers[RFLAG_REG] & 0x0100:
+                    return RunResult(RunResult.HALTED, steps)
+        except IoWait as error:
+            return self._stopped(block.last, steps + block.length - 1, error)
+        except Exception as error:
+            # The instructions of the block before the one that raised have run
+            index = block.failed_at(error.__traceback__) if block is not None else None
+            if index is None:
+                return self._stopped(start, steps, error)
+            return self._stopped(block.addresses[index], steps + index, error)
+
+        result = super()._execute(limit - steps)
+        result.steps += steps
+        return result
+
+    def _next_block(self, ip):
+        # Follow the link cached in the previous block before the block cache
+        previous = self._block
+        block = previous.links.get(ip) if previous is not None else None
+        if block is None or not block.valid:
+            block = self._block_cache.get(ip)
+            if block is None:
+                block = self._translate(ip)
+            if previous is not None:
+                previous.links[ip] = block
+        self._block = block
+        return block
+
+    def restore(self, snapshot):
+        super().restore(snapshot)
+        self._block = None
+
+    def flush_decode_cache(self):
+        super().flush_decode_cache()
+        for block in self._block_cache.values():
+            block.valid = False
+        self._block_cache.clear()
+        self._block = None
+
+    def drop_changed_code(self, words):
+        super().drop_changed_code(words)
+        memory = self.memory.memory
+        for start, block in list(self._block_cache.items()):
+            if block.end > len(memory) or memory[start:block.end] != words[start:block.end]:
+                block.valid = False
+                del self._block_cache[start]
+        self._block = None
+
+    def _invalidate(self, address):
+        invalidated = super()._invalidate(address)
+        for start, block in list(self._block_cache.items()):
+            if (address - block.start) & 0xFFFF < block.end - block.start:
+                block.valid = False
+                del self._block_cache[start]
+                invalidated = True
+        return invalidated
+
+    def _translate(self, start):
+        instructions = []
+        address = start
+        while True:
+            try:
+                decoded = self._decode_at(address)
+            except InvalidInstruction:
+                # Leave the fault to be raised when execution gets there
+                if not instructions:
+                    raise
+                break
+            instructions.append(decoded)
+            address += decoded.size
+            if (self._ends_block(decoded)
+                    or len(instructions) >= self.MAX_BLOCK_LENGTH
+                    or address > 0xFFFF):
+                break
+
+        source, lines = self._block_source(start, instructions)
+        namespace = {'r': self.registers, 'm': self.memory.memory, 'w': self._mem_write}
+        for index, decoded in enumerate(instructions):
+            if decoded.opcode == 0x1 or self._uses_device(decoded):
+                namespace[f'd{index}'] = decoded
+        exec(compile(source, f"<block {hex(start)}>", "exec"), namespace)
+
+        addresses = [start]
+        for decoded in instructions[:-1]:
+            addresses.append(addresses[-1] + decoded.size)
+        block = TranslatedBlock(start, address, addresses[-1], len(instructions),
+                                namespace['block'], addresses, lines)
+        self._block_cache[start] = block
+        for covered in range(start, address):
+            self._code_words[covered & 0xFFFF] = 1
+        return block
+
+    def _block_source(self, start, instructions):
+        # Drop NZP updates that a later instruction of the block overwrites
+        # before anything can observe them
+        keep_flags = [True] * len(instructions)
+        live = True
+        for index in range(len(instructions) - 1, -1, -1):
+            decoded = instructions[index]
+            if self._may_exit_early(decoded):
+                live = True
+            if sets_nzp_flags(decoded.opcode, decoded.src_type, decoded.dst_type):
+                keep_flags[index] = live
+                live = False
+            if decoded.opcode in (0xD, 0xF):
+                live = True
+
+        arguments = ['r=r', 'm=m', 'w=w']
+        body = []
+        # line of the source each instruction starts on, after the def line
+        starts = []
+        address = start
+        last = len(instructions) - 1
+        for index, decoded in enumerate(instructions):
+            starts.append(len(body) + 2)
+            address += decoded.size
+            next_ip = address & 0xFFFF
+            if index == last or self._touches_ip(decoded):
+                body.append(f"r[4] = {hex(next_ip)}")
+
+            if decoded.opcode == 0x1 or self._uses_device(decoded):
+                arguments.append(f'd{index}=d{index}')
+                body.append(f"d{index}.execute()")
+                continue
+
+            if index == last:
+                write = plain_write
+            else:
+                def write(target, value, then=(), next_ip=next_ip, executed=index + 1):
+                    # Stop early if the store invalidated translated code
+                    return ([f"stale = w({target}, {value})"] + list(then)
+                            + ["if stale:",
+                               f"    r[4] = {hex(next_ip)}",
+                               f"    return {executed}"])
+            src_type = decoded.src_type
+            src = self._operand(src_type, decoded.src_reg, decoded.src_word)
+            if reads_ip_early(decoded):
+                src_type, src = 'imm', hex((address - decoded.size + 1) & 0xFFFF)
+            body += emit_instruction(decoded.opcode, src_type, decoded.dst_type, src,
+                                     self._operand(decoded.dst_type, decoded.dst_reg, decoded.dst_word),
+                                     write, keep_flags[index])
+        body.append(f"return {len(instructions)}")
+
+        lines = [f"def block({', '.join(arguments)}):"]
+        lines += ["    " + line for line in body]
+        return "\n".join(lines) + "\n", starts
+
+    def _ends_block(self, decoded):
+        opcode = decoded.opcode
+        if opcode in (0x1, 0xC, 0xD, 0xE, 0xF):
+            return True
+        # Devices may raise IoWait, which rewinds to the last instruction
+        if self._uses_device(decoded):
+            return True
+        # Writes to IP transfer control like a jump
+        if opcode in (0x3, 0x6, 0x7):
+            return decoded.src_type == 'reg' and decoded.src_reg == RIP_REG
+        return (opcode != 0xB and decoded.dst_type == 'reg'
+                and decoded.dst_reg == RIP_REG)
+
+    def _touches_ip(self, decoded):
+        # Reads of IP inside a block need the architectural value
+        return ((decoded.src_type == 'reg' and decoded.src_reg == RIP_REG)
+                or (decoded.dst_type == 'reg' and decoded.dst_reg == RIP_REG))
+
+    def _may_exit_early(self, decoded):
+        opcode = decoded.opcode
+        if opcode in (0x2, 0x3, 0x6, 0x7):
+            return decoded.src_type == 'mem_adr' or opcode == 0x2
+        return decoded.dst_type == 'mem_adr' and opcode != 0xB
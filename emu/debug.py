@@ -0,0 +1,234 @@
+"""Breakpoints and watchpoints for LLAMA-16 programs.
+
+A Debugger adds itself to the CPU as a hook, and its watchpoints to the
+memory bus as devices, only while it has breakpoints or watchpoints set.
+Without any, programs run on the normal fast paths.
+"""
+import sys
+try:
+    from .cpu import RunResult, StopExecution
+    from .dev import Device
+    from .mem import PAGE_SHIFT
+except ImportError:
+    from cpu import RunResult, StopExecution
+    from dev import Device
+    from mem import PAGE_SHIFT
+
+# What a stop handler returns
+CONTINUE = 'continue'
+STEP = 'step'
+QUIT = 'quit'
+
+
+class DebugStop(StopExecution):
+    """Why the Debugger stopped the CPU.
+
+    kind is 'breakpoint', 'step', 'read' or 'write'. For watchpoints the
+    address and value are of the memory access, which was made by the
+    instruction before the one the CPU stopped at.
+    """
+
+    def __init__(self, kind, address, value=None):
+        super().__init__(kind, address, value)
+        self.kind = kind
+        self.address = address
+        self.value = value
+
+    def __str__(self):
+        if self.value is None:
+            return f"{self.kind} at {hex(self.address)}"
+        return f"{self.kind} of {hex(self.value)} at {hex(self.address)}"
+
+
+class WatchDevice(Device):
+    """Passes accesses through to memory and reports them to a Debugger."""
+
+    def __init__(self, debugger, memory, start, read, write):
+        self.debugger = debugger
+        self.memory = memory
+        self.start = start
+        self.watch_read = read
+        self.watch_write = write
+
+    def read(self, offset):
+        address = self.start + offset
+        value = self.memory.memory[address]
+        if self.watch_read:
+            self.debugger.hits.append(DebugStop('read', address, value))
+        return value
+
+    def write(self, offset, value):
+        address = self.start + offset
+        self.memory.memory[address] = value
+        self.memory.dirty[address >> PAGE_SHIFT] = 1
+        if self.watch_write:
+            self.debugger.hits.append(DebugStop('write', address, value))
+
+
+class Debugger(object):
+    """Breakpoints and watchpoints on a Machine.
+
+    Args:
+        machine: The Machine to debug
+        handler: Called as handler(debugger, stop) whenever run() stops at a
+            DebugStop. Returns CONTINUE, STEP to run one instruction and stop
+            again, or QUIT. None quits at the first stop.
+    """
+
+    def __init__(self, machine, handler=None):
+        self.machine = machine
+        self.handler = handler
+        self.breakpoints = set()
+        # start -> (end, WatchDevice)
+        self.watchpoints = {}
+        # accesses seen by watch devices since the last instruction started
+        self.hits = []
+        self._hooked = False
+        self._resume = None
+
+    def add_breakpoint(self, location):
+        """Stop before the instruction at an address or label. Returns the address."""
+        address = self._address(location)
+        self.breakpoints.add(address)
+        self._update()
+        return address
+
+    def remove_breakpoint(self, location):
+        self.breakpoints.discard(self._address(location))
+        self._update()
+
+    def add_watchpoint(self, start, end=None, read=False, write=True):
+        """Stop after any instruction that reads or writes start to end."""
+        start = self._address(start)
+        end = start if end is None else self._address(end)
+        device = WatchDevice(self, self.machine.memory, start, read, write)
+        self.machine.attach(device, start, end)
+        self.watchpoints[start] = (end, device)
+        self._update()
+
+    def remove_watchpoint(self, start):
+        end, device = self.watchpoints.pop(self._address(start))
+        self.machine.detach(device)
+        self._update()
+
+    def record(self, ip, decoded):
+        resume, self._resume = self._resume, None
+        if self.hits:
+            stop = self.hits[0]
+            self.hits.clear()
+            self._resume = ip
+            raise stop
+        if ip in self.breakpoints and ip != resume:
+            self._resume = ip
+            raise DebugStop('breakpoint', ip)
+
+    def finish(self, steps=None):
+        pass
+
+    def run(self, max_steps=None):
+        """Run the machine, passing every stop to the handler, and return the
+        last MachineResult. Its steps are counted over the whole call."""
+        steps = 0
+        stepping = False
+        while True:
+            budget = None if max_steps is None else max_steps - steps
+            if stepping:
+                budget = 1 if budget is None else min(budget, 1)
+            result = self.machine.run(budget)
+            steps += result.steps
+            if result.reason == RunResult.BREAKPOINT:
+                stop = result.error
+            elif stepping and result.reason == RunResult.MAX_STEPS and steps != max_steps:
+                stop = DebugStop('step', self.machine.cpu.registers[4])
+            else:
+                break
+            command = self.handler(self, stop) if self.handler is not None else QUIT
+            if command == QUIT:
+                break
+            stepping = command == STEP
+        result.steps = steps
+        return result
+
+    def describe(self, address):
+        return self.machine.symbols.describe(address)
+
+    def _address(self, location):
+        # Labels like F or ADD are also valid hex, so they are looked up first
+        if isinstance(location, int):
+            return location
+        try:
+            return self.machine.symbols.address(location)
+        except KeyError:
+            return int(location, 16)
+
+    def _update(self):
+        # The hook is only there while something can stop the CPU
+        wanted = bool(self.breakpoints or self.watchpoints)
+        if wanted and not self._hooked:
+            self.machine.cpu.add_hook(self)
+        elif self._hooked and not wanted:
+            self.machine.cpu.remove_hook(self)
+        self._hooked = wanted
+
+
+def _read_command(prompt):
+    """Read a debugger command from the terminal.
+
+    Programs read io from stdin, which may be a pipe or file of their
+    input, so commands come from /dev/tty instead. Without one, stdin is
+    only used when it is itself a terminal. Raises EOFError when there is
+    nowhere to read commands from.
+    """
+    try:
+        with open('/dev/tty', 'r+') as tty:
+            tty.write(prompt)
+            tty.flush()
+            line = tty.readline()
+    except OSError:
+        if not sys.stdin.isatty():
+            print("No terminal to read debugger commands from")
+            raise EOFError
+        return input(prompt)
+    if not line:
+        raise EOFError
+    return line
+
+
+def console_handler(debugger, stop):
+    """An interactive stop handler reading commands from the terminal."""
+    cpu = debugger.machine.cpu
+    print(f"Stopped on {stop.kind}", end='')
+    if stop.kind in ('read', 'write'):
+        print(f" of {hex(stop.value)} at {hex(stop.address)}", end='')
+    print(f", next instruction at {debugger.describe(cpu.registers[4])}")
+    while True:
+        try:
+            command, *args = _read_command("(llama) ").split() or ['']
+        except EOFError:
+            return QUIT
+        try:
+            if command in ('c', 'continue'):
+                return CONTINUE
+            elif command in ('s', 'step'):
+                return STEP
+            elif command in ('q', 'quit'):
+                return QUIT
+            elif command in ('r', 'regs'):
+                cpu.dump_state()
+            elif command in ('m', 'mem'):
+                address = debugger._address(args[0])
+                count = int(args[1]) if len(args) > 1 else 8
+                words = debugger.machine.memory.memory[address:address + count]
+                print(f"{hex(address)}: " + " ".join(f"{word:04x}" for word in words))
+            elif command in ('b', 'break'):
+                print(f"Breakpoint at {hex(debugger.add_breakpoint(args[0]))}")
+            elif command in ('d', 'delete'):
+                debugger.remove_breakpoint(args[0])
+            elif command in ('w', 'watch'):
+                end = args[1] if len(args) > 1 else None
+                debugger.add_watchpoint(args[0], end, read=False, write=True)
+            else:
+                print("Commands: c(ontinue), s(tep), q(uit), r(egs), m(em) ADDR [COUNT],\n"
+                      "          b(reak) ADDR|LABEL, d(elete) ADDR|LABEL, w(atch) START [END]")
+        except (IndexError, KeyError, ValueError) as error:
+            print(f"Invalid command: {error!r}")
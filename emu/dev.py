@@ -0,0 +1,123 @@
+"""Devices for the LLAMA-16 memory bus.
+
+A device is attached to a range of addresses with LLAMAMemory.attach or
+Machine.attach. Reads and writes of those addresses call its read(offset)
+and write(offset, value), where offset counts from the start of the range.
+SPEC.txt puts console input at 0xFFFE and output at 0xFFFF, which is the
+layout of StreamDevice and ConsoleDevice attached at 0xFFFE.
+"""
+import collections
+import os
+import sys
+try:
+    from .stream import InputExhausted
+except ImportError:
+    from stream import InputExhausted
+
+CONSOLE_START = 0xFFFE
+CONSOLE_END = 0xFFFF
+
+
+class Device(object):
+    """A device that reads as zero and ignores writes."""
+
+    def read(self, offset):
+        return 0
+
+    def write(self, offset, value):
+        pass
+
+    def flush(self):
+        """Write out anything buffered, called when Machine.run returns."""
+        pass
+
+
+class BufferDevice(Device):
+    """An in-memory character device.
+
+    Reading offset 0 takes the next word from input, 0 once it is empty.
+    Writing offset 1 appends the word to output.
+    """
+
+    def __init__(self, words=()):
+        self.input = collections.deque(words)
+        self.output = []
+
+    def read(self, offset):
+        if offset == 0 and self.input:
+            return self.input.popleft()
+        return 0
+
+    def write(self, offset, value):
+        if offset == 1:
+            self.output.append(value)
+
+
+class StreamDevice(Device):
+    """A character device on text streams.
+
+    Reading offset 0 returns the next character of stdin, raising
+    InputExhausted at the end of input. Writing offset 1 writes the character to stdout.
+    Output is buffered until a newline, a read or flush().
+    """
+
+    def __init__(self, stdin, stdout):
+        self.stdin = stdin
+        self.stdout = stdout
+        self._input = ''
+        self._output = []
+
+    def read(self, offset):
+        if offset != 0:
+            return 0
+        if not self._input:
+            self.flush()
+            self._input = self.stdin.readline()
+            if not self._input:
+                raise InputExhausted
+        char, self._input = self._input[0], self._input[1:]
+        return ord(char)
+
+    def write(self, offset, value):
+        if offset == 1:
+            self._output.append(chr(value))
+            if value == 0x0A:
+                self.flush()
+
+    def flush(self):
+        if self._output:
+            self.stdout.write(''.join(self._output))
+            self._output.clear()
+            self.stdout.flush()
+
+
+class ConsoleDevice(StreamDevice):
+    """A StreamDevice on the emulator's console."""
+
+    def __init__(self):
+        super().__init__(sys.stdin, sys.stdout)
+
+
+class FileDevice(Device):
+    """Word addressed storage backed by a binary file.
+
+    Offset n is the little endian word at byte 2 * n of the file. Reads past
+    the end of the file return 0 and writes past it grow the file.
+    """
+
+    def __init__(self, filename):
+        self.file = open(filename, 'r+b' if os.path.exists(filename) else 'w+b')
+
+    def read(self, offset):
+        self.file.seek(2 * offset)
+        return int.from_bytes(self.file.read(2).ljust(2, b'\0'), 'little')
+
+    def write(self, offset, value):
+        self.file.seek(2 * offset)
+        self.file.write(value.to_bytes(2, 'little'))
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
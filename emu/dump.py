@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""Compact binary dumps of LLAMA-16 memory and registers.
+
+A dump starts with the magic b'L16D', a format version, the eight
+registers and the number of pages that follow. Each page is its page number
+and its 256 words. Only pages holding a non-zero word are written, so a
+crashed program usually dumps in a few KiB. Every value is a little endian
+16 bit word.
+
+Run this file on a dump to print it as text.
+"""
+import argparse
+import array
+import struct
+import sys
+try:
+    from .mem import PAGE_SIZE, PAGE_SHIFT
+except ImportError:
+    from mem import PAGE_SIZE, PAGE_SHIFT
+
+MAGIC = b'L16D'
+VERSION = 1
+HEADER = struct.Struct('<4sH8HH')
+PAGE_NUMBER = struct.Struct('<H')
+REGISTER_NAMES = ['A', 'B', 'C', 'D', 'IP', 'SP', 'BP', 'FLAGS']
+
+
+def dump_memory(memory, registers=None):
+    """Return the dump of an LLAMAMemory and optional register list as bytes."""
+    # SP is left past 16 bits by a push at the top of memory
+    registers = [register & 0xFFFF for register in registers] if registers is not None else [0] * 8
+    pages = []
+    for page in memory.used_pages():
+        start = page << PAGE_SHIFT
+        words = memory.memory[start:start + PAGE_SIZE]
+        if any(words):
+            pages.append((page, words))
+
+    chunks = [HEADER.pack(MAGIC, VERSION, *registers, len(pages))]
+    for page, words in pages:
+        if sys.byteorder == 'big':
+            words.byteswap()
+        chunks += [PAGE_NUMBER.pack(page), words.tobytes()]
+    return b''.join(chunks)
+
+
+def write_dump(filename, memory, registers=None):
+    with open(filename, 'wb') as file:
+        file.write(dump_memory(memory, registers))
+
+
+def read_dump(data):
+    """Return (registers, {page number: array of words}) from a dump."""
+    magic, version, *registers, count = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("not a LLAMA-16 memory dump")
+    pages = {}
+    offset = HEADER.size
+    for _ in range(count):
+        page, = PAGE_NUMBER.unpack_from(data, offset)
+        offset += PAGE_NUMBER.size
+        words = array.array('H')
+        words.frombytes(data[offset:offset + 2 * PAGE_SIZE])
+        if sys.byteorder == 'big':
+            words.byteswap()
+        pages[page] = words
+        offset += 2 * PAGE_SIZE
+    return registers, pages
+
+
+def render_dump(data):
+    """Return a dump as text laid out like the emulator's debug output."""
+    registers, pages = read_dump(data)
+    lines = ["======== LLAMA-16 CPU State ========"]
+    lines += [f"{name + ':':<6} {hex(value)}" for name, value in zip(REGISTER_NAMES, registers)]
+    lines += ["", "========== LLAMA-16 Memory Map =========="]
+    for page in sorted(pages):
+        start = page << PAGE_SHIFT
+        lines += [f"{hex(start + offset)}: {hex(word)}"
+                  for offset, word in enumerate(pages[page]) if word]
+    lines.append("=========== END OF Memory Map ===========")
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="LLAMA-16 memory dump printer")
+    parser.add_argument("dump", help="dump file to print")
+    args = parser.parse_args()
+    with open(args.dump, 'rb') as file:
+        print(render_dump(file.read()))
@@ -0,0 +1,261 @@
+import io
+import os
+import time
+try:
+    from .mem import LLAMAMemory
+    from .cpu import LLAMACpu, LLAMABlockCpu, RunResult
+    from .dump import dump_memory
+    from .tracer import TraceBuffer
+    from .profiler import Profiler
+    from .counters import PerfCounters
+    from .sym import SymbolTable, symbols_for
+except ImportError:
+    from mem import LLAMAMemory
+    from cpu import LLAMACpu, LLAMABlockCpu, RunResult
+    from dump import dump_memory
+    from tracer import TraceBuffer
+    from profiler import Profiler
+    from counters import PerfCounters
+    from sym import SymbolTable, symbols_for
+
+
+class MachineResult(RunResult):
+    """A RunResult plus the output and registers left behind by the run."""
+
+    def __init__(self, reason, steps, error=None, output=None, registers=None, elapsed=0.0):
+        super().__init__(reason, steps, error)
+        self.output = output
+        self.registers = registers
+        self.elapsed = elapsed
+
+
+class MachineSnapshot(object):
+    """Everything needed to put a Machine back where it was, see Machine.snapshot()."""
+    __slots__ = ('memory', 'registers', 'stdin', 'stdin_position', 'output', 'steps')
+
+    def __init__(self, memory, registers, stdin, stdin_position, output, steps):
+        self.memory = memory
+        self.registers = registers
+        self.stdin = stdin
+        self.stdin_position = stdin_position
+        self.output = output
+        self.steps = steps
+
+
+class Machine(object):
+    """A LLAMA-16 memory and CPU that can be loaded and run from Python.
+
+    Nothing here reads sys.argv or exits the process, so a single interpreter
+    can load and run any number of programs one after another.
+
+    Args:
+        program: Optional program to load, see load()
+        stdin: Input for io, a string, a list of lines, a text file object,
+            a callable returning a line at a time or an InputSource from
+            emu.stream. None reads from the console like the emulator does.
+        stdout: Text file object for io output. None captures the output
+            and returns it in MachineResult.output.
+        jit: Use the block translating LLAMABlockCpu
+        debug_mode: Dump the CPU state before every instruction
+    """
+    # With a timeout, how many instructions run between clock checks
+    TIMEOUT_CHECK_STEPS = 100000
+
+    def __init__(self, program=None, stdin=None, stdout=None, jit=False, debug_mode=False):
+        self.memory = LLAMAMemory()
+        cpu_class = LLAMABlockCpu if jit else LLAMACpu
+        self.cpu = cpu_class(self.memory, debug_mode)
+        self.jit = jit
+        self.steps = 0
+        # Labels of the loaded program, from the .SYM file next to it
+        self.symbols = SymbolTable()
+        self.profiler = None
+        self.counters = None
+        self._captured = None
+        self.set_io(stdin, stdout)
+        if program is not None:
+            self.load(program)
+
+    def set_io(self, stdin=None, stdout=None):
+        """Replace the io streams. When output was already being captured
+        and still is, the text captured so far is kept."""
+        self.cpu.stdin = stdin
+
+        if stdout is None:
+            if self._captured is None:
+                self._captured = io.StringIO()
+            stdout = self._captured
+        else:
+            self._captured = None
+        self.cpu.stdout = stdout
+
+    def load(self, program, symbols=None):
+        """Load a program from a path, binary file object or bytes-like buffer
+        and reset the CPU to run it from the start.
+
+        symbols is a SymbolTable for the program. By default the .SYM file
+        next to a program path is loaded when there is one.
+        """
+        self.memory.load_program(program)
+        if symbols is None:
+            if isinstance(program, (str, os.PathLike)):
+                symbols = symbols_for(program)
+            else:
+                symbols = SymbolTable()
+        self.symbols = symbols
+        self.cpu.reset()
+        self.steps = 0
+        if self._captured is not None:
+            self.cpu.output.flush()
+            self._captured.seek(0)
+            self._captured.truncate()
+
+    def run(self, max_steps=None, timeout=None):
+        """Run until the CPU stops, max_steps instructions have executed or
+        timeout seconds have passed. Returns a MachineResult."""
+        start = time.perf_counter()
+        if timeout is None:
+            result = self.cpu.run(max_steps)
+        else:
+            result = self._run_with_timeout(max_steps, start + timeout)
+        self.steps += result.steps
+        self.memory.flush_devices()
+
+        return MachineResult(result.reason, result.steps, result.error,
+                             self.output(), list(self.cpu.registers),
+                             time.perf_counter() - start)
+
+    def attach(self, device, start, end=None):
+        """Attach a device to addresses start to end of memory, see emu.dev."""
+        self.memory.attach(device, start, end)
+        self.cpu.flush_decode_cache()
+
+    def detach(self, device):
+        self.memory.detach(device)
+        self.cpu.flush_decode_cache()
+
+    def start_trace(self, size=1024):
+        """Keep the last size instructions executed in a TraceBuffer and return it.
+
+        Tracing runs the interpreter, even with jit, at a fraction of its
+        usual speed.
+        """
+        trace = TraceBuffer(size)
+        self.cpu.set_trace(trace)
+        return trace
+
+    def stop_trace(self):
+        self.cpu.set_trace(None)
+
+    def start_profile(self):
+        """Count every instruction executed from now on in a Profiler and
+        return it. Like tracing, profiling runs the interpreter."""
+        self.stop_profile()
+        self.profiler = Profiler()
+        self.cpu.add_hook(self.profiler)
+        return self.profiler
+
+    def stop_profile(self):
+        if self.profiler is not None:
+            self.cpu.remove_hook(self.profiler)
+            self.profiler = None
+
+    def profile_report(self, limit=10):
+        """The profile as text, with addresses named after the program's labels."""
+        return self.profiler.report(self.symbols, limit)
+
+    def start_stats(self, costs=None):
+        """Count instructions, memory accesses and guest cycles from now on
+        in a PerfCounters and return it. costs is a CostTable from
+        emu.counters. Like profiling, counting runs the interpreter."""
+        self.stop_stats()
+        self.counters = PerfCounters(costs)
+        self.counters.attach(self.cpu)
+        self.cpu.add_hook(self.counters)
+        return self.counters
+
+    def stop_stats(self):
+        if self.counters is not None:
+            self.cpu.remove_hook(self.counters)
+            self.counters = None
+
+    def snapshot(self):
+        """Capture memory, registers and io position as a MachineSnapshot.
+
+        Memory is copied with a single buffer copy, so taking a snapshot costs
+        about the same as copying 128 KiB. Console and callback input can not
+        be rewound, other input sources keep their position.
+        """
+        stdin = self.cpu.stdin
+        position = stdin.tell()
+        return MachineSnapshot(self.memory.snapshot(), self.cpu.snapshot(), stdin,
+                               position, self.output(), self.steps)
+
+    def restore(self, snapshot):
+        """Put the machine back to a snapshot taken from it or any other Machine.
+
+        Decoded instructions and translated blocks are kept unless the words
+        they came from differ in the snapshot. The stdin position is only
+        restored when stdin is still the stream the snapshot was taken with,
+        so new input can be given with set_io() before or after restoring.
+        """
+        self.cpu.drop_changed_code(snapshot.memory.words)
+        self.memory.restore(snapshot.memory)
+        self.cpu.restore(snapshot.registers)
+        self.steps = snapshot.steps
+        if snapshot.stdin_position is not None and self.cpu.stdin is snapshot.stdin:
+            self.cpu.stdin.seek(snapshot.stdin_position)
+        if self._captured is not None:
+            self.cpu.output.flush()
+            self._captured.seek(0)
+            self._captured.truncate()
+            self._captured.write(snapshot.output or "")
+
+    def fork(self, stdin=None, stdout=None):
+        """Return a new Machine in the current state of this one.
+
+        The fork has its own memory, registers and io, and starts with empty
+        decode caches. stdin and stdout are as for the constructor.
+        """
+        machine = Machine(stdin=stdin, stdout=stdout, jit=self.jit,
+                          debug_mode=self.cpu.debug_mode)
+        snapshot = self.snapshot()
+        snapshot.stdin = None
+        machine.restore(snapshot)
+        return machine
+
+    def output(self):
+        """Everything written by io since the program was loaded, when captured."""
+        if self._captured is None:
+            return None
+        self.cpu.output.flush()
+        return self._captured.getvalue()
+
+    def dump(self):
+        """Return the registers and used memory as a binary dump, see emu.dump."""
+        return dump_memory(self.memory, self.cpu.registers)
+
+    def diff(self, snapshot=None):
+        """Return (address, old, new) for every word of memory that differs
+        from the loaded program, or from a MachineSnapshot when given."""
+        return self.memory.diff(snapshot.memory if snapshot is not None else None)
+
+    def dump_state(self):
+        self.cpu.dump_state()
+        self.memory.dump_mem_map()
+
+    def _run_with_timeout(self, max_steps, deadline):
+        steps = 0
+        while True:
+            chunk = self.TIMEOUT_CHECK_STEPS
+            if max_steps is not None:
+                chunk = min(chunk, max_steps - steps)
+            result = self.cpu.run(chunk)
+            steps += result.steps
+            if result.reason != RunResult.MAX_STEPS or steps == max_steps:
+                break
+            if time.perf_counter() >= deadline:
+                result = RunResult(RunResult.TIMEOUT, steps)
+                break
+        result.steps = steps
+        return result
@@ -1,38 +1,243 @@
 import array
+import os
+import sys
+
+# Programs are loaded at this word address
+PROGRAM_START = 0x4000
+# Words per page of the dirty page map
+PAGE_SIZE = 256
+PAGE_SHIFT = 8
 
 
 class LLAMAMemory(object):
+    """The 64 Ki words of LLAMA-16 memory plus a bus for memory mapped devices.
+
+    While no device is attached mem_read and mem_write are plain array
+    accesses. Attaching one swaps in versions that look the address up in
+    a map of device addresses first.
+
+    mem_write marks the page it writes as dirty. Since loading wipes memory,
+    only dirty pages and the pages of the loaded image can hold anything,
+    so dumps and diffs only have to look at those.
+    """
+    # Copied over memory to wipe it
+    _blank = array.array('H', bytes(2 * 2**16))
 
     def __init__(self):
         self.mem_size = 2**16
-        self.memory = array.array('H', [0 for i in range(self.mem_size)])
+        self.memory = array.array('H', bytes(2 * self.mem_size))
+        # The words of the loaded program and one flag per page written since
+        self.image = array.array('H')
+        self.dirty = bytearray(self.mem_size // PAGE_SIZE)
+        # (start, end, device) for every attached device, plus the device
+        # number + 1 of every address so lookups are a single index
+        self.devices = []
+        self._device_map = bytearray(self.mem_size)
+        self.view = DeviceView(self)
+
+    def attach(self, device, start, end=None):
+        """Send reads and writes of addresses start to end, inclusive, to device.
+
+        Raises ValueError when the range is outside memory or overlaps an
+        attached device. Decoded instructions of a CPU using this memory
+        have to be flushed afterwards, which Machine.attach does.
+        """
+        end = start if end is None else end
+        if not 0 <= start <= end < self.mem_size:
+            raise ValueError(f"invalid device range {hex(start)}-{hex(end)}")
+        if any(self._device_map[start:end + 1]):
+            raise ValueError(f"device range {hex(start)}-{hex(end)} is already in use")
+        if len(self.devices) == 255:
+            raise ValueError("too many devices")
+        self.devices.append((start, end, device))
+        self._map_devices()
+
+    def detach(self, device):
+        """Remove every address range sent to device."""
+        self.devices = [entry for entry in self.devices if entry[2] is not device]
+        self._map_devices()
+
+    def device_at(self, address):
+        """Return (start, device) when address belongs to a device, else None."""
+        index = self._device_map[address]
+        if index:
+            start, end, device = self.devices[index - 1]
+            return start, device
+        return None
 
-    def load_program(self, filename):
+    def flush_devices(self):
+        for start, end, device in self.devices:
+            device.flush()
+
+    def load_program(self, program):
+        """Load a program image at 0x4000.
+
+        program can be a path, a binary file object or any bytes-like buffer.
+        Images are little endian 16 bit words. Raises ValueError when the
+        image has an odd number of bytes or does not fit above 0x4000.
+        """
         self._wipe_memory()
-        prog_bytes = self._read_program(filename)
+        if isinstance(program, (str, os.PathLike)):
+            with open(program, 'rb', buffering=0) as f:
+                size = self._read_program(f)
+        elif hasattr(program, 'readinto'):
+            size = self._read_program(program)
+        elif hasattr(program, 'read'):
+            size = self._copy_program(program.read())
+        else:
+            size = self._copy_program(program)
+
+        if size % 2:
+            raise ValueError(f"program image has an odd number of bytes ({size})")
+        end = PROGRAM_START + size // 2
+        if sys.byteorder == 'big':
+            words = self.memory[PROGRAM_START:end]
+            words.byteswap()
+            self.memory[PROGRAM_START:end] = words
+        self.image = self.memory[PROGRAM_START:end]
+
+    def snapshot(self):
+        """Return a MemorySnapshot holding a copy of every word of memory."""
+        return MemorySnapshot(self.memory[:], bytes(self.dirty), self.image)
+
+    def restore(self, snapshot):
+        """Copy a snapshot back into memory, keeping the same backing array."""
+        self.memory[:] = snapshot.words
+        self.dirty[:] = snapshot.dirty
+        self.image = snapshot.image
+
+    def used_pages(self):
+        """Page numbers of every page that may hold a non-zero word."""
+        pages = bytearray(self.dirty)
+        if self.image:
+            first = PROGRAM_START >> PAGE_SHIFT
+            last = (PROGRAM_START + len(self.image) - 1) >> PAGE_SHIFT
+            pages[first:last + 1] = b'\1' * (last + 1 - first)
+        return [page for page, used in enumerate(pages) if used]
+
+    def diff(self, snapshot=None):
+        """Return (address, old, new) for every word that differs from the
+        loaded image, or from a MemorySnapshot when one is given."""
+        pages = set(self.used_pages())
+        if snapshot is None:
+            old = self._blank[:]
+            old[PROGRAM_START:PROGRAM_START + len(self.image)] = self.image
+        else:
+            old = snapshot.words
+            pages.update(page for page, used in enumerate(snapshot.dirty) if used)
+            if snapshot.image is not self.image and snapshot.image:
+                first = PROGRAM_START >> PAGE_SHIFT
+                last = (PROGRAM_START + len(snapshot.image) - 1) >> PAGE_SHIFT
+                pages.update(range(first, last + 1))
 
-        for i in range(0, len(prog_bytes)):
-            self.memory[0x4000+i] = prog_bytes[i]
+        changes = []
+        memory = self.memory
+        for page in sorted(pages):
+            start = page << PAGE_SHIFT
+            end = start + PAGE_SIZE
+            if memory[start:end] == old[start:end]:
+                continue
+            for address in range(start, end):
+                if memory[address] != old[address]:
+                    changes.append((address, old[address], memory[address]))
+        return changes
 
     def mem_write(self, address, value):
         self.memory[address] = value
+        self.dirty[address >> 8] = 1
 
     def mem_read(self, address):
         return self.memory[address]
 
     def dump_mem_map(self):
-        print("========== LLAMA-16 Memory Map ==========")
-        for i in range(2**16):
-            if self.memory[i] != 0:
-                print(f"{hex(i)}: {hex(self.memory[i])}")
-        print("=========== END OF Memory Map ===========")
-
-    def _read_program(self, filename):
-        prog_bytes = array.array('H', range(0))
-        with open(filename, 'rb') as f:
-            prog_bytes.frombytes(f.read())
-        return prog_bytes
+        lines = ["========== LLAMA-16 Memory Map =========="]
+        memory = self.memory
+        for page in self.used_pages():
+            start = page << PAGE_SHIFT
+            if any(memory[start:start + PAGE_SIZE]):
+                lines += [f"{hex(i)}: {hex(memory[i])}"
+                          for i in range(start, start + PAGE_SIZE) if memory[i]]
+        lines.append("=========== END OF Memory Map ===========")
+        print("\n".join(lines))
+
+    def _device_write(self, address, value):
+        index = self._device_map[address]
+        if index:
+            start, end, device = self.devices[index - 1]
+            device.write(address - start, value)
+        else:
+            self.memory[address] = value
+            self.dirty[address >> 8] = 1
+
+    def _device_read(self, address):
+        index = self._device_map[address]
+        if index:
+            start, end, device = self.devices[index - 1]
+            return device.read(address - start) & 0xFFFF
+        return self.memory[address]
+
+    def _map_devices(self):
+        self._device_map = bytearray(self.mem_size)
+        for index, (start, end, device) in enumerate(self.devices):
+            self._device_map[start:end + 1] = bytes([index + 1]) * (end + 1 - start)
+        if self.devices:
+            self.mem_read = self._device_read
+            self.mem_write = self._device_write
+        else:
+            self.__dict__.pop('mem_read', None)
+            self.__dict__.pop('mem_write', None)
+
+    def _read_program(self, file):
+        """Read an image straight into memory, returning its size in bytes."""
+        with memoryview(self.memory).cast('B') as view:
+            region = view[2 * PROGRAM_START:]
+            size = 0
+            while size < len(region):
+                count = file.readinto(region[size:])
+                if not count:
+                    break
+                size += count
+            region.release()
+        if size == 2 * (self.mem_size - PROGRAM_START) and file.read(1):
+            self._too_large(size + len(file.read()) + 1)
+        return size
+
+    def _copy_program(self, data):
+        """Copy an image from a buffer into memory, returning its size in bytes."""
+        with memoryview(data).cast('B') as data:
+            size = len(data)
+            if size > 2 * (self.mem_size - PROGRAM_START):
+                self._too_large(size)
+            with memoryview(self.memory).cast('B') as view:
+                view[2 * PROGRAM_START:2 * PROGRAM_START + size] = data
+        return size
+
+    def _too_large(self, size):
+        limit = 2 * (self.mem_size - PROGRAM_START)
+        raise ValueError(f"program image is {size} bytes, only {limit} fit above {hex(PROGRAM_START)}")
 
     def _wipe_memory(self):
-        for i in range(self.mem_size):
-            self.memory[i] = 0
+        self.memory[:] = self._blank
+        self.dirty[:] = bytes(len(self.dirty))
+        self.image = array.array('H')
+
+
+class MemorySnapshot(object):
+    """A copy of memory with its dirty page map and loaded image."""
+    __slots__ = ('words', 'dirty', 'image')
+
+    def __init__(self, words, dirty, image):
+        self.words = words
+        self.dirty = dirty
+        self.image = image
+
+
+class DeviceView(object):
+    """Indexes like the backing array, but reads go through the device bus."""
+    __slots__ = ('_memory',)
+
+    def __init__(self, memory):
+        self._memory = memory
+
+    def __getitem__(self, address):
+        return self._memory.mem_read(address)
@@ -0,0 +1,102 @@
+"""Instruction profiles of LLAMA-16 programs.
+
+A Profiler counts how often every address and every opcode executes.
+Its report groups the counts by the label each address belongs to, finds
+loops from backward jnz instructions and ends with an opcode histogram.
+"""
+import array
+try:
+    from .cpu import MNEMONICS
+    from .sym import SymbolTable
+except ImportError:
+    from cpu import MNEMONICS
+    from sym import SymbolTable
+
+
+class Profiler(object):
+    """Counts executed instructions. Add it to a CPU with add_hook()."""
+
+    def __init__(self):
+        self.counts = array.array('Q', bytes(8 * 2**16))
+        self.opcodes = [0] * 16
+        # jnz address -> target, for finding loops
+        self.branches = {}
+        # the last instruction counted and the total when the last run finished
+        self._last_ip = self._last_opcode = None
+        self._finished = 0
+
+    def record(self, ip, decoded):
+        self.counts[ip] += 1
+        opcode = decoded.opcode
+        self.opcodes[opcode] += 1
+        self._last_ip = ip
+        self._last_opcode = opcode
+        if opcode == 0xD and ip not in self.branches:
+            self.branches[ip] = decoded.src_word
+
+    def finish(self, steps=None):
+        """Take back the last instruction counted if the run stopped before
+        running it, so the total agrees with the steps of every run."""
+        total = self.total
+        if steps is not None and total - self._finished > steps:
+            self.counts[self._last_ip] -= 1
+            self.opcodes[self._last_opcode] -= 1
+            total -= 1
+        self._finished = total
+
+    def clear(self):
+        self.counts = array.array('Q', bytes(8 * 2**16))
+        self.opcodes = [0] * 16
+        self.branches.clear()
+        self._finished = 0
+
+    @property
+    def total(self):
+        return sum(self.opcodes)
+
+    def hot_labels(self, symbols):
+        """Return (label, instructions) pairs, most executed first."""
+        labels = {}
+        for address, count in enumerate(self.counts):
+            if count:
+                found = symbols.lookup(address)
+                label = found[0] if found is not None else "(no label)"
+                labels[label] = labels.get(label, 0) + count
+        return sorted(labels.items(), key=lambda item: item[1], reverse=True)
+
+    def hot_loops(self):
+        """Return (start, end, instructions, iterations) for every backward
+        jnz, most executed first. end is the address of the jnz."""
+        loops = []
+        for end, start in self.branches.items():
+            if start is None or start > end:
+                continue
+            instructions = sum(self.counts[start:end + 1])
+            loops.append((start, end, instructions, self.counts[start]))
+        return sorted(loops, key=lambda loop: loop[2], reverse=True)
+
+    def report(self, symbols=None, limit=10):
+        """Return the profile as text, showing the limit hottest of each kind."""
+        symbols = symbols if symbols is not None else SymbolTable()
+        total = self.total or 1
+        lines = ["======== LLAMA-16 Profile ========",
+                 f"{self.total} instructions executed", "",
+                 "Hot labels:",
+                 f"{'instructions':>14} {'%':>6}  label"]
+        for label, count in self.hot_labels(symbols)[:limit]:
+            lines.append(f"{count:>14} {100 * count / total:>5.1f}%  {label}")
+
+        lines += ["", "Hot loops:",
+                  f"{'instructions':>14} {'iterations':>11}  loop"]
+        for start, end, instructions, iterations in self.hot_loops()[:limit]:
+            lines.append(f"{instructions:>14} {iterations:>11}  "
+                         f"{symbols.describe(start)} to {symbols.describe(end)} "
+                         f"({hex(start)}-{hex(end)})")
+
+        lines += ["", "Opcodes:"]
+        opcodes = sorted(range(16), key=lambda opcode: self.opcodes[opcode], reverse=True)
+        for opcode in opcodes:
+            count = self.opcodes[opcode]
+            if count:
+                lines.append(f"{MNEMONICS[opcode]:<6} {count:>14} {100 * count / total:>5.1f}%")
+        return "\n".join(lines)
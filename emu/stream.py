@@ -0,0 +1,207 @@
+"""Buffered io streams for the LLAMA-16 CPU."""
+import sys
+
+
+class IoWait(Exception):
+    """Raised by io when no input is available yet."""
+    pass
+
+
+class InputExhausted(IoWait):
+    """Raised by io when the input has ended and no more will come."""
+    pass
+
+
+class OutputSink(object):
+    """Collects io output and writes it to a text stream in large chunks.
+
+    The buffer is written out once it holds size characters, when flush()
+    is called and, when line_buffered, after every newline. The CPU flushes
+    it whenever run() returns and before reading input, so prompts still
+    show up before the program waits for an answer.
+
+    Args:
+        stream: Text file object to write to, sys.stdout when None
+        size: Number of buffered characters that triggers a flush
+        line_buffered: Flush after newlines. None turns it on when the
+            stream is a terminal.
+    """
+
+    def __init__(self, stream=None, size=8192, line_buffered=None):
+        self.size = size
+        self.line_buffered = line_buffered
+        self._buffer = []
+        self._length = 0
+        self.stream = stream
+
+    @property
+    def stream(self):
+        return self._stream
+
+    @stream.setter
+    def stream(self, stream):
+        if self._buffer:
+            self.flush()
+        self._stream = stream
+        self._line_buffered = self.line_buffered
+        if self._line_buffered is None:
+            target = sys.stdout if stream is None else stream
+            isatty = getattr(target, 'isatty', None)
+            self._line_buffered = bool(isatty and isatty())
+
+    def write(self, text):
+        self._buffer.append(text)
+        self._length += len(text)
+        if self._length >= self.size or (self._line_buffered and '\n' in text):
+            self.flush()
+
+    def flush(self):
+        if not self._buffer:
+            return
+        stream = sys.stdout if self._stream is None else self._stream
+        stream.write(''.join(self._buffer))
+        self._buffer.clear()
+        self._length = 0
+        stream.flush()
+
+
+# Stands in for numbers io can not store, which fault when they are read
+OVERFLOW = object()
+
+
+def parse_line(line):
+    """Parse one line of io input into an int, OVERFLOW or the line itself."""
+    try:
+        value = int(line)
+    except ValueError:
+        return line
+    if value > 32767 or value < -32768:
+        return OVERFLOW
+    return value
+
+
+def input_source(stdin):
+    """Wrap anything Machine accepts as stdin in an InputSource.
+
+    None reads the console, a string or a list holds the lines up front,
+    a callable is called for every line and a text file object is read a
+    line at a time.
+    """
+    if stdin is None:
+        return ConsoleSource()
+    elif isinstance(stdin, InputSource):
+        return stdin
+    elif isinstance(stdin, str):
+        return LineSource(stdin.splitlines())
+    elif isinstance(stdin, (list, tuple)):
+        return LineSource(stdin)
+    elif hasattr(stdin, 'readline'):
+        return StreamSource(stdin)
+    elif callable(stdin):
+        return CallbackSource(stdin)
+    raise TypeError(f"unsupported io input {stdin!r}")
+
+
+class InputSource(object):
+    """Supplies io IN with parsed lines of input.
+
+    next_value() returns an int for numbers and a str for anything else. It
+    raises IoWait when no input is available yet and InputExhausted once
+    the input has ended.
+    """
+
+    def next_value(self):
+        raise InputExhausted
+
+    def tell(self):
+        """A position that seek() can return to, or None when it can not rewind."""
+        return None
+
+    def seek(self, position):
+        pass
+
+
+class LineSource(InputSource):
+    """Input parsed up front from a list of lines."""
+
+    def __init__(self, lines):
+        self.values = [parse_line(str(line)) for line in lines]
+        self.position = 0
+
+    def next_value(self):
+        if self.position >= len(self.values):
+            raise InputExhausted
+        value = self.values[self.position]
+        self.position += 1
+        return value
+
+    def tell(self):
+        return self.position
+
+    def seek(self, position):
+        self.position = position
+
+
+class FileSource(LineSource):
+    """Input parsed up front from every line of a text file."""
+
+    def __init__(self, filename):
+        with open(filename, 'r') as file:
+            super().__init__(file.read().splitlines())
+
+
+class StreamSource(InputSource):
+    """Input read a line at a time from a text file object or pipe."""
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def next_value(self):
+        line = self.stream.readline()
+        if not line:
+            raise InputExhausted
+        return parse_line(line.rstrip('\r\n'))
+
+    def tell(self):
+        if self.stream.seekable():
+            return self.stream.tell()
+        return None
+
+    def seek(self, position):
+        self.stream.seek(position)
+
+
+class ConsoleSource(InputSource):
+    """Input typed at the console, or read a line at a time when piped in."""
+
+    def next_value(self):
+        if sys.stdin.isatty():
+            try:
+                line = input()
+            except EOFError:
+                raise InputExhausted
+        else:
+            line = sys.stdin.readline()
+            if not line:
+                raise InputExhausted
+        return parse_line(line.rstrip('\r\n'))
+
+
+class CallbackSource(InputSource):
+    """Input returned by calling callback() for every line.
+
+    The callback returns a line or a number, None when nothing is available
+    yet, or raises EOFError when the input has ended.
+    """
+
+    def __init__(self, callback):
+        self.callback = callback
+
+    def next_value(self):
+        try:
+            line = self.callback()
+        except EOFError:
+            raise InputExhausted
+        if line is None:
+            raise IoWait
+        return parse_line(str(line))
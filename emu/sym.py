@@ -0,0 +1,59 @@
+"""Symbol tables written by the assembler's -s flag.
+
+A .SYM file has one label per line, its address as four hex digits then
+its name in upper case, e.g. "4009 OUTER".
+"""
+from bisect import bisect_right
+from pathlib import Path
+
+
+class SymbolTable(object):
+    """Labels by address, for turning addresses into names and back."""
+
+    def __init__(self, symbols=()):
+        self._symbols = sorted((address, name.upper()) for name, address in symbols)
+        self._addresses = [address for address, name in self._symbols]
+        self._by_name = {name: address for address, name in self._symbols}
+
+    def __len__(self):
+        return len(self._symbols)
+
+    def lookup(self, address):
+        """Return (label, offset) of the nearest label at or before address,
+        or None when there is none."""
+        index = bisect_right(self._addresses, address) - 1
+        if index < 0:
+            return None
+        start, name = self._symbols[index]
+        return name, address - start
+
+    def address(self, name):
+        """Return the address of a label, raising KeyError when it is unknown."""
+        return self._by_name[name.upper()]
+
+    def describe(self, address):
+        """Return an address as LABEL or LABEL+offset, or in hex without a label."""
+        found = self.lookup(address)
+        if found is None:
+            return hex(address)
+        name, offset = found
+        return f"{name}+{offset}" if offset else name
+
+
+def load_symbols(filename):
+    """Read a .SYM file into a SymbolTable."""
+    symbols = []
+    with open(filename, 'r', encoding="utf-8") as file:
+        for line in file:
+            fields = line.split()
+            if len(fields) == 2:
+                symbols.append((fields[1], int(fields[0], 16)))
+    return SymbolTable(symbols)
+
+
+def symbols_for(program):
+    """Load the .SYM file next to a program path, or return an empty table."""
+    filename = Path(program).with_suffix(".SYM")
+    if filename.exists():
+        return load_symbols(filename)
+    return SymbolTable()
@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+"""Execution traces of the last instructions a LLAMA-16 CPU ran.
+
+A TraceBuffer is a fixed size ring of records kept in one preallocated
+array, so tracing can stay on for long runs and still tell what happened
+right before a fault. Every record is seven 16 bit words:
+
+    ip           address of the instruction
+    instruction  the instruction word
+    src_word     trailing source word, 0 when there is none
+    dst_word     trailing destination word, 0 when there is none
+    kind         TARGET_NONE, TARGET_REG or TARGET_MEM
+    target       register encoding or memory address written
+    value        the value written there
+
+Saved traces are a header followed by the records, oldest first, as
+little endian words. Run this file on a saved trace to print it.
+"""
+import argparse
+import array
+import struct
+import sys
+try:
+    from .cpu import MNEMONICS
+except ImportError:
+    from cpu import MNEMONICS
+
+RECORD_WORDS = 7
+TARGET_NONE = 0
+TARGET_REG = 1
+TARGET_MEM = 2
+
+MAGIC = b'L16T'
+HEADER = struct.Struct('<4sI')
+REGISTER_NAMES = ['a', 'b', 'c', 'd', 'ip', 'sp', 'bp', 'f']
+
+
+class TraceBuffer(object):
+    """Keeps the last size instructions executed by a CPU.
+
+    Pass it to cpu.set_trace(), or use Machine.start_trace(), and the CPU
+    calls record() before every instruction. The value a record wrote is filled
+    in when the next instruction starts or when finish() is called.
+    """
+
+    def __init__(self, size=1024):
+        self.size = size
+        self.words = array.array('H', bytes(2 * RECORD_WORDS * size))
+        self.count = 0
+        self.position = 0
+        self._registers = None
+        self._memory = None
+        self._pending = -1
+        # DecodedInstruction -> the fields record() stores for it
+        self._fields = {}
+        # records made in total, and by the time the last run finished
+        self.recorded = 0
+        self._finished = 0
+
+    def attach(self, cpu):
+        self._registers = cpu.registers
+        self._memory = cpu.memory.memory
+
+    def clear(self):
+        self.count = 0
+        self.position = 0
+        self._pending = -1
+        self._fields.clear()
+        self.recorded = 0
+        self._finished = 0
+
+    def record(self, ip, decoded):
+        words = self.words
+        pending = self._pending
+        if pending >= 0:
+            # The previous instruction has run, store what it wrote
+            if words[pending + 4] == TARGET_REG:
+                words[pending + 6] = self._registers[words[pending + 5]] & 0xFFFF
+            else:
+                words[pending + 6] = self._memory[words[pending + 5]]
+            self._pending = -1
+        fields = self._fields.get(decoded)
+        if fields is None:
+            fields = self._fields[decoded] = self._describe(decoded)
+        instruction, src_word, dst_word, kind, target = fields
+        if target < 0:
+            target = self._registers[5] & 0xFFFF
+
+        index = self.position * RECORD_WORDS
+        words[index] = ip
+        words[index + 1] = instruction
+        words[index + 2] = src_word
+        words[index + 3] = dst_word
+        words[index + 4] = kind
+        words[index + 5] = target
+        if kind:
+            self._pending = index
+
+        self.recorded += 1
+        self.position += 1
+        if self.position == self.size:
+            self.position = 0
+            self.count = self.size
+        elif self.count < self.size:
+            self.count += 1
+
+    def finish(self, steps=None):
+        """Fill in the value written by the most recent record.
+
+        steps is the number of instructions the run that just returned
+        executed. When the run stopped before running the most recent
+        record's instruction, that record is dropped instead, as the
+        instruction is recorded again when the run is resumed.
+        """
+        if steps is not None and self.recorded - self._finished > steps:
+            self.recorded -= 1
+            self.position = (self.position - 1) % self.size
+            self.count -= 1
+            if self._pending == self.position * RECORD_WORDS:
+                self._pending = -1
+        self._finished = self.recorded
+        index = self._pending
+        if index < 0:
+            return
+        kind = self.words[index + 4]
+        target = self.words[index + 5]
+        if kind == TARGET_REG:
+            value = self._registers[target]
+        else:
+            value = self._memory[target]
+        self.words[index + 6] = value & 0xFFFF
+        self._pending = -1
+
+    def records(self):
+        """Return the records, oldest first, as tuples of seven words."""
+        self.finish()
+        first = (self.position - self.count) % self.size
+        words = self.words
+        result = []
+        for offset in range(self.count):
+            index = ((first + offset) % self.size) * RECORD_WORDS
+            result.append(tuple(words[index:index + RECORD_WORDS]))
+        return result
+
+    def to_bytes(self):
+        records = array.array('H')
+        for record in self.records():
+            records.extend(record)
+        if sys.byteorder == 'big':
+            records.byteswap()
+        return HEADER.pack(MAGIC, len(records) // RECORD_WORDS) + records.tobytes()
+
+    def save(self, filename):
+        with open(filename, 'wb') as file:
+            file.write(self.to_bytes())
+
+    def format(self):
+        return format_trace(self.records())
+
+    def _describe(self, decoded):
+        # Everything recorded for an instruction that does not change
+        # between runs of it. A target of -1 is the stack slot SP points
+        # at before the instruction, where push and call write.
+        if len(self._fields) >= 4096:
+            self._fields.clear()
+        instruction = (decoded.opcode << 12) | (decoded.src_reg << 4) | decoded.dst_reg
+        opcode = decoded.opcode
+        if opcode in (0x0, 0x4, 0x5, 0x8, 0x9, 0xA):
+            if decoded.dst_type == 'reg':
+                kind, target = TARGET_REG, decoded.dst_reg
+            else:
+                kind, target = TARGET_MEM, decoded.dst_word
+        elif opcode in (0x3, 0x6, 0x7) or (opcode == 0x1 and decoded.dst_reg == 0x1):
+            if decoded.src_type == 'reg':
+                kind, target = TARGET_REG, decoded.src_reg
+            else:
+                kind, target = TARGET_MEM, decoded.src_word
+        elif opcode in (0x2, 0xC):
+            kind, target = TARGET_MEM, -1
+        elif opcode in (0xB, 0xF):
+            kind, target = TARGET_REG, 7
+        else:
+            kind, target = TARGET_NONE, 0
+        return instruction, decoded.src_word or 0, decoded.dst_word or 0, kind, target
+
+
+def read_trace(data):
+    """Return the records of a saved trace."""
+    magic, count = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError("not a LLAMA-16 trace")
+    words = array.array('H')
+    words.frombytes(data[HEADER.size:HEADER.size + 2 * RECORD_WORDS * count])
+    if sys.byteorder == 'big':
+        words.byteswap()
+    return [tuple(words[index:index + RECORD_WORDS])
+            for index in range(0, len(words), RECORD_WORDS)]
+
+
+def disassemble(instruction, src_word, dst_word):
+    opcode = instruction >> 12
+    src = (instruction & 0x00F0) >> 4
+    dst = instruction & 0x000F
+    mnemonic = MNEMONICS[opcode]
+    if opcode in (0xC, 0xD):
+        return f"{mnemonic} {hex(src_word)}"
+    if opcode >= 0xE:
+        return mnemonic
+
+    operands = [_operand(src, src_word)]
+    if opcode == 0x1:
+        operands.append('IN' if dst == 0x1 else 'OUT')
+    elif opcode not in (0x2, 0x3, 0x6, 0x7):
+        operands.append(_operand(dst, dst_word))
+    return f"{mnemonic} {', '.join(operands)}"
+
+
+def format_trace(records):
+    lines = []
+    for ip, instruction, src_word, dst_word, kind, target, value in records:
+        line = f"{hex(ip)}: {disassemble(instruction, src_word, dst_word)}"
+        if kind == TARGET_REG:
+            line = f"{line:<32} {REGISTER_NAMES[target]} = {hex(value)}"
+        elif kind == TARGET_MEM:
+            line = f"{line:<32} [{target:04x}] = {hex(value)}"
+        lines.append(line)
+    return "\n".join(lines)
+
+
+def _operand(encode, word):
+    if encode < 0x7:
+        return REGISTER_NAMES[encode]
+    if encode == 0xE:
+        return f"#{hex(word)}"
+    return f"[{word:04x}]"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="LLAMA-16 trace printer")
+    parser.add_argument("trace", help="trace file to print")
+    args = parser.parse_args()
+    with open(args.trace, 'rb') as file:
+        print(format_trace(read_trace(file.read())))
@@ -0,0 +1,421 @@
+#!/usr/bin/env python3
+"""Run one LLAMA-16 program on many inputs at once with NumPy.
+
+A LockstepMachine holds the registers of N machines as an (N, 8) array and
+their memory as an (N, 65536) array of 16 bit words. Every step it takes
+the lowest IP of the running machines and executes the instruction there
+for all machines at that IP with one vectorized operation, so machines
+that branched apart wait for each other and run together again once they
+reach the same code. Machines that spread out too far, or that are about
+to push past the top or pop past the bottom of memory, are finished one
+at a time on the scalar interpreter from emu/cpu.py.
+
+Memory takes 128 KiB per machine. NumPy is only needed by this module.
+
+Run this file on a program and a file with one set of input per line,
+values separated by spaces, to compare its aggregate speed with the
+interpreter.
+"""
+import argparse
+import io
+import sys
+import time
+from array import array
+try:
+    import numpy as np
+except ImportError:
+    np = None
+try:
+    from .codegen import ALU_OPERATIONS
+    from .cpu import (LLAMACpu, RunResult, InvalidInstruction, IP_START, SP_START,
+                      BP_START, decode_instruction, reads_ip_early)
+    from .machine import Machine, MachineResult
+    from .mem import LLAMAMemory
+    from .stream import IoWait, InputExhausted, OVERFLOW, input_source
+except ImportError:
+    from codegen import ALU_OPERATIONS
+    from cpu import (LLAMACpu, RunResult, InvalidInstruction, IP_START, SP_START,
+                     BP_START, decode_instruction, reads_ip_early)
+    from machine import Machine, MachineResult
+    from mem import LLAMAMemory
+    from stream import IoWait, InputExhausted, OVERFLOW, input_source
+
+# The codegen templates work on NumPy arrays as well as on ints
+ALU_FUNCTIONS = {opcode: eval("lambda dst, src: " + operation.format(dst="dst", src="src"))
+                 for opcode, operation in ALU_OPERATIONS.items()}
+
+
+class LockstepMachine(object):
+    """Many LLAMA-16 machines running the same program in lockstep.
+
+    Args:
+        program: Path to an assembled program or its bytes, loaded into
+            every machine
+        inputs: One io input per machine, anything Machine accepts as stdin.
+            Its length is the number of machines.
+        min_occupancy: Once fewer than this share of the running machines
+            execute each step on average, the rest finish on the interpreter
+        min_lanes: Fewer running machines than this also finish on the
+            interpreter, which is faster for a handful of them
+    """
+    # Steps over which occupancy is averaged
+    OCCUPANCY_WINDOW = 256
+
+    def __init__(self, program, inputs, min_occupancy=0.25, min_lanes=4):
+        if np is None:
+            raise ImportError("the lockstep engine needs NumPy")
+        image = LLAMAMemory()
+        image.load_program(program)
+        self.count = len(inputs)
+        self.registers = np.empty((self.count, 8), dtype=np.uint16)
+        self.registers[:] = [0, 0, 0, 0, IP_START, SP_START, BP_START, 0]
+        self.memory = np.empty((self.count, image.mem_size), dtype=np.uint16)
+        self.memory[:] = np.frombuffer(image.memory, dtype=np.uint16)
+        self.steps = np.zeros(self.count, dtype=np.int64)
+        self.running = np.ones(self.count, dtype=bool)
+        self.inputs = [input_source(stdin) for stdin in inputs]
+        self.outputs = [[] for _ in range(self.count)]
+        self.results = [None] * self.count
+        self.min_occupancy = min_occupancy
+        self.min_lanes = min_lanes
+        # vectorized steps, and machines that finished on the interpreter
+        self.dispatches = 0
+        self.fallbacks = 0
+        self.elapsed = 0.0
+        # address -> DecodedInstruction of code no machine has written to,
+        # the words those cover, and every word any machine has stored to
+        self._decoded = {}
+        self._code_words = np.zeros(image.mem_size, dtype=bool)
+        self._written = np.zeros(image.mem_size, dtype=bool)
+        self._active = None
+        self._limit = float('inf')
+
+    @property
+    def instructions(self):
+        return int(self.steps.sum())
+
+    @property
+    def rate(self):
+        """Guest instructions per second over all machines."""
+        return self.instructions / self.elapsed if self.elapsed else 0.0
+
+    def run(self, max_steps=None):
+        """Run every machine until it stops or has run max_steps instructions.
+
+        Returns a MachineResult per machine, in the order of inputs.
+        """
+        start = time.perf_counter()
+        limit = self._limit = max_steps if max_steps is not None else float('inf')
+        window_lanes = window_slots = window_steps = 0
+        try:
+            while True:
+                active = self._running()
+                if active.size < self.min_lanes:
+                    for lane in active.tolist():
+                        self._fallback(lane, limit)
+                    break
+                if not active.size:
+                    break
+                ips = self.registers[active, 4]
+                ip = int(ips.min())
+                lanes = active[ips == ip]
+                self._step(ip, lanes)
+                self.dispatches += 1
+
+                if max_steps is not None:
+                    for lane in lanes[self.steps[lanes] >= limit].tolist():
+                        if self.running[lane]:
+                            self._finish(lane, RunResult.MAX_STEPS)
+
+                window_lanes += lanes.size
+                window_slots += active.size
+                window_steps += 1
+                if window_steps == self.OCCUPANCY_WINDOW:
+                    if window_lanes < self.min_occupancy * window_slots:
+                        for lane in self._running().tolist():
+                            self._fallback(lane, limit)
+                    window_lanes = window_slots = window_steps = 0
+        finally:
+            self.elapsed += time.perf_counter() - start
+        return list(self.results)
+
+    def _running(self):
+        if self._active is None:
+            self._active = np.flatnonzero(self.running)
+        return self._active
+
+    def _finish(self, lane, reason, error=None, registers=None):
+        self.running[lane] = False
+        self._active = None
+        if registers is None:
+            registers = [int(register) for register in self.registers[lane]]
+        self.results[lane] = MachineResult(reason, int(self.steps[lane]), error,
+                                           ''.join(self.outputs[lane]), registers)
+
+    def _fallback(self, lane, limit):
+        # Finish one machine on the interpreter and copy its state back
+        memory = LLAMAMemory()
+        memory.memory[:] = array('H', self.memory[lane].tobytes())
+        output = io.StringIO()
+        cpu = LLAMACpu(memory, stdin=self.inputs[lane], stdout=output)
+        cpu.registers[:] = [int(register) for register in self.registers[lane]]
+        remaining = None if limit == float('inf') else int(limit - self.steps[lane])
+        result = cpu.run(remaining)
+
+        # SP can leave 16 bits on the interpreter, the result keeps it as is
+        self.registers[lane] = [register & 0xFFFF for register in cpu.registers]
+        self.memory[lane] = np.frombuffer(memory.memory, dtype=np.uint16)
+        self.steps[lane] += result.steps
+        self.outputs[lane].append(output.getvalue())
+        self.fallbacks += 1
+        self._finish(lane, result.reason, result.error, list(cpu.registers))
+
+    def _step(self, ip, lanes):
+        try:
+            decoded, shared = self._decode(ip, lanes)
+        except InvalidInstruction as error:
+            # Only the machines holding the same instruction word fault
+            words = self.memory[lanes, ip]
+            for lane in lanes[words == words[0]].tolist():
+                self._finish(lane, RunResult.FAULT, error)
+            return
+        if not shared:
+            # Machines may have different code here, the ones that do not
+            # match the first run at a later step
+            addresses = (ip + np.arange(decoded.size)) & 0xFFFF
+            words = self.memory[np.ix_(lanes, addresses)]
+            lanes = lanes[(words == words[0]).all(axis=1)]
+
+        opcode = decoded.opcode
+        if opcode in (0x2, 0x3, 0xC, 0xE):
+            # SP would leave 16 bits, which only the interpreter can follow
+            edge = 0xFFFF if opcode in (0x2, 0xC) else 0
+            stuck = self.registers[lanes, 5] == edge
+            if stuck.any():
+                for lane in lanes[stuck].tolist():
+                    self._fallback(lane, self._limit)
+                lanes = lanes[~stuck]
+                if not lanes.size:
+                    return
+
+        self.registers[lanes, 4] = (ip + decoded.size) & 0xFFFF
+        if opcode == 0x1:
+            lanes = self._io(ip, decoded, lanes)
+        else:
+            self._execute(decoded, lanes)
+        self.steps[lanes] += 1
+        if opcode == 0xF:
+            for lane in lanes.tolist():
+                self._finish(lane, RunResult.HALTED)
+
+    def _decode(self, ip, lanes):
+        # Returns the instruction of the first machine and whether every
+        # machine is known to hold the same one
+        decoded = self._decoded.get(ip)
+        if decoded is not None:
+            return decoded, True
+        row = self.memory[lanes[0]]
+        decoded = decode_instruction(lambda address: int(row[address]), ip)
+        addresses = (ip + np.arange(decoded.size)) & 0xFFFF
+        if self._written[addresses].any():
+            return decoded, False
+        # Nothing stored here yet, so it is still the loaded program
+        self._decoded[ip] = decoded
+        self._code_words[addresses] = True
+        return decoded, True
+
+    def _store(self, lanes, address, value):
+        self.memory[lanes, address] = value
+        self._written[address] = True
+        if self._code_words[address].any():
+            self._decoded.clear()
+            self._code_words[:] = False
+
+    def _value(self, lanes, op_type, register, word):
+        if op_type == 'imm':
+            return word
+        if op_type == 'reg':
+            return self.registers[lanes, register].astype(np.int64)
+        return self.memory[lanes, word].astype(np.int64)
+
+    def _execute(self, decoded, lanes):
+        # Same effects as the codegen templates, one array operation each
+        r = self.registers
+        opcode = decoded.opcode
+        src_type, dst_type = decoded.src_type, decoded.dst_type
+        src, dst = decoded.src_reg, decoded.dst_reg
+        value = self._value(lanes, src_type, src, decoded.src_word) if src_type else None
+        if reads_ip_early(decoded):
+            # IP already points past the whole instruction
+            value = (value - decoded.size + 1) & 0xFFFF
+
+        if opcode == 0x0:
+            if dst_type == 'reg':
+                r[lanes, dst] = value
+            elif dst_type == 'mem_adr':
+                self._store(lanes, decoded.dst_word, value)
+        elif opcode in ALU_FUNCTIONS:
+            operation = ALU_FUNCTIONS[opcode]
+            if dst_type == 'reg':
+                v = operation(r[lanes, dst].astype(np.int64), value)
+                r[lanes, dst] = v
+                r[lanes, 7] = (r[lanes, 7] & 0xFFF0) + _nzp(v)
+            elif dst_type == 'mem_adr':
+                address = decoded.dst_word
+                self._store(lanes, address,
+                            operation(self.memory[lanes, address].astype(np.int64), value))
+        elif opcode in (0x6, 0x7):
+            step = 1 if opcode == 0x6 else -1
+            if src_type == 'reg':
+                v = (value + step) & 0xFFFF
+                r[lanes, src] = v
+                r[lanes, 7] = (r[lanes, 7] & 0xFFF0) + _nzp(v)
+            elif src_type == 'mem_adr':
+                self._store(lanes, decoded.src_word, (value + step) & 0xFFFF)
+        elif opcode == 0x2:
+            sp = r[lanes, 5].astype(np.int64)
+            self._store(lanes, sp, value)
+            r[lanes, 5] = sp + 1
+        elif opcode == 0x3:
+            sp = r[lanes, 5].astype(np.int64) - 1
+            r[lanes, 5] = sp
+            v = self.memory[lanes, sp]
+            if src_type == 'reg':
+                r[lanes, src] = v
+            elif src_type == 'mem_adr':
+                self._store(lanes, decoded.src_word, v)
+        elif opcode == 0xB:
+            if dst_type == 'reg':
+                v = r[lanes, dst].astype(np.int64)
+                gel = np.where(value < v, 0x10, np.where(value == v, 0x20, 0x40))
+                r[lanes, 7] = (r[lanes, 7] & 0xFF00) + _nzp(v) + gel
+        elif opcode == 0xC:
+            sp = r[lanes, 5].astype(np.int64)
+            self._store(lanes, sp, r[lanes, 4])
+            r[lanes, 5] = sp + 1
+            r[lanes, 4] = decoded.src_word
+        elif opcode == 0xD:
+            taken = lanes[(r[lanes, 7] & 0x2) == 0]
+            r[taken, 4] = decoded.src_word
+        elif opcode == 0xE:
+            sp = r[lanes, 5].astype(np.int64) - 1
+            r[lanes, 5] = sp
+            r[lanes, 4] = self.memory[lanes, sp]
+        elif opcode == 0xF:
+            r[lanes, 7] += 0x100
+
+    def _io(self, ip, decoded, lanes):
+        # io differs for every machine, so it runs one machine at a time.
+        # Returns the machines that did not stop.
+        done = []
+        for lane in lanes.tolist():
+            try:
+                self._lane_io(lane, decoded)
+            except Exception as error:
+                self.registers[lane, 4] = ip
+                if isinstance(error, InputExhausted):
+                    self._finish(lane, RunResult.INPUT_EXHAUSTED)
+                elif isinstance(error, IoWait):
+                    self._finish(lane, RunResult.IO_WAIT)
+                else:
+                    self._finish(lane, RunResult.FAULT, error)
+            else:
+                done.append(lane)
+        return np.array(done, dtype=np.intp)
+
+    def _lane_io(self, lane, decoded):
+        # The same as LLAMACpu._io for one machine
+        src_type = decoded.src_type
+        registers = self.registers[lane]
+        if decoded.dst_reg == 0x1:
+            inp = self.inputs[lane].next_value()
+            if inp is OVERFLOW:
+                raise OverflowError
+            if isinstance(inp, int):
+                if src_type == 'reg':
+                    registers[decoded.src_reg] = inp & 0xFFFF
+                elif src_type == 'mem_adr':
+                    self._store([lane], decoded.src_word, inp & 0xFFFF)
+                return
+            data = inp + ('\0\0' if len(inp) % 2 == 0 else '\0')
+            if src_type == 'reg':
+                if len(inp) < 2:
+                    inp += '\0'
+                registers[decoded.src_reg] = ((ord(inp[0]) << 8) + ord(inp[1])) & 0xFFFF
+            elif src_type == 'mem_adr':
+                address = decoded.src_word
+                for i in range(0, len(data), 2):
+                    word = (ord(data[i + 1]) << 8) + ord(data[i])
+                    self._store([lane], address, word & 0xFFFF)
+                    address += 1
+        elif decoded.dst_reg == 0x2:
+            if src_type == 'imm':
+                self.outputs[lane].append(str(_twos(decoded.src_word)))
+            elif src_type == 'reg':
+                self.outputs[lane].append(str(_twos(int(registers[decoded.src_reg]))))
+            elif src_type == 'mem_adr':
+                self.outputs[lane].append(self._read_string(lane, decoded.src_word))
+
+    def _read_string(self, lane, address):
+        # Both characters of every word up to and including the one holding
+        # the terminating NUL, low byte first
+        row = self.memory[lane]
+        chunk = 64
+        while True:
+            words = row[address:address + chunk]
+            ends = np.flatnonzero(((words & 0xFF) == 0) | ((words >> 8) == 0))
+            if ends.size:
+                return words[:ends[0] + 1].astype('<u2').tobytes().decode('latin-1')
+            if address + chunk >= row.size:
+                raise IndexError("array index out of range")
+            chunk *= 4
+
+
+def _nzp(v):
+    return np.where(v == 0, 2, np.where(v > 0x7FFF, 4, 1))
+
+
+def _twos(value):
+    return value - (1 << 16) if value & (1 << 15) else value
+
+
+def main():
+    parser = argparse.ArgumentParser(description="LLAMA-16 lockstep engine benchmark")
+    parser.add_argument("program", help="assembled program to run")
+    parser.add_argument("inputs",
+                        help="file with the input of one machine per line, values separated by spaces")
+    parser.add_argument("--max-steps", type=int, metavar="N",
+                        help="stop every machine after N instructions")
+    parser.add_argument("--check", action="store_true",
+                        help="also run every input on the interpreter and compare the results")
+    args = parser.parse_args()
+
+    with open(args.inputs, 'r') as file:
+        inputs = [line.split() for line in file.read().splitlines()]
+    machine = LockstepMachine(args.program, inputs)
+    results = machine.run(args.max_steps)
+    print(f"{len(inputs)} machines, {machine.instructions} instructions in {machine.elapsed:.3f} s: "
+          f"{machine.rate:,.0f} instructions/s, {machine.dispatches} vector steps, "
+          f"{machine.fallbacks} machines finished on the interpreter")
+
+    if args.check:
+        scalar = Machine(args.program)
+        start = time.perf_counter()
+        mismatches = 0
+        for index, stdin in enumerate(inputs):
+            scalar.load(args.program)
+            scalar.set_io(stdin)
+            expected = scalar.run(args.max_steps)
+            result = results[index]
+            if ((expected.reason, expected.steps, expected.output, expected.registers)
+                    != (result.reason, result.steps, result.output, result.registers)):
+                mismatches += 1
+                print(f"machine {index} differs: {result!r}, expected {expected!r}")
+        elapsed = time.perf_counter() - start
+        print(f"interpreter: {machine.instructions / elapsed:,.0f} instructions/s, "
+              f"{mismatches} mismatches")
+        sys.exit(1 if mismatches else 0)
+
+
+if __name__ == "__main__":
+    main()
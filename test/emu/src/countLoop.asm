@@ -0,0 +1,6 @@
+; Stopping at the jnz with -b 4004 must leave --profile and --stats
+; counting the 2 instructions that ran before it, not the jnz as well
+mv #3, a
+sub #1, a
+jnz 4002
+hlt
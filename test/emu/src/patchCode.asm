@@ -0,0 +1,7 @@
+; Every machine patches the immediate of the mv at 0x4003 with its own
+; input before that mv first runs, so each one prints its own number
+io a, IN
+mv a, [4004]
+mv #0, b
+io b, OUT
+hlt
@@ -0,0 +1,7 @@
+; The second push runs past the top of memory and faults with SP at
+; 0x10000, which a --batch dump_dir still has to dump. The interpreter
+; and --jit must both stop after 2 instructions with IP at 0x4003
+mv #-1, sp
+push a
+push a
+hlt